@@ -1,3 +1,52 @@
 DATA_DIR = '/alongtrack-delivery'
 OUTPUT_DIR = '/pipeline_output'
-FILE_FORMAT = '.h5'
\ No newline at end of file
+FILE_FORMAT = '.h5'
+
+# Cycle gridding parallelism: processes in the pool, threads per process
+GRIDDING_WORKERS = 1
+GRIDDING_THREADS = 4
+
+# Named profile from conf/gridding_profiles.yaml used for cycle gridding
+DEFAULT_GRIDDING_PROFILE = 'production'
+
+# Gridded cycle file format: 'full' 360x720 planes or 'compact' wet cell vectors
+GRIDDED_CYCLE_FORMAT = 'full'
+
+# Streaming gridding: cycles merged ahead of the one being gridded, reader
+# threads merging them and cap on memory held by merged cycles waiting to be
+# gridded. Set the prefetch to 0 to merge, grid and write each cycle in turn.
+GRIDDING_PREFETCH = 2
+GRIDDING_READERS = 2
+GRIDDING_PREFETCH_MAX_BYTES = 4 * 1024**3
+
+# Decoded granule cache shared by overlapping cycles. Set the size to 0 to disable.
+GRANULE_CACHE_DIR = f'{OUTPUT_DIR}/granule_cache'
+GRANULE_CACHE_MAX_BYTES = 20 * 1024**3
+
+# netCDF outputs: compression codec (zlib, or zstd, bzip2... with xarray >= 2022.09
+# and netCDF4 >= 1.6, checked at startup; None for uncompressed), its level,
+# chunk size per dimension (unlisted dimensions are not split) and the number
+# of products allowed to wait for the background writer.
+OUTPUT_CODEC = 'zlib'
+OUTPUT_COMPLEVEL = 5
+OUTPUT_CHUNKS = {}
+OUTPUT_PENDING_WRITES = 2
+
+# Approximate memory used to export products spanning every cycle (ie: globals.nc),
+# which are read and written a block of cycles at a time.
+EXPORT_MAX_BYTES = 1024**3
+
+# Indicators are only recalculated for new or regridded cycles, which overwrite
+# their slot in the indicator stores. Set to True to recalculate every cycle each run.
+INDICATORS_FULL_REBUILD = False
+
+# Chunk sizes of the indicator stores
+INDICATOR_STORE_CHUNKS = {'time': 16, 'latitude': 60, 'longitude': 120}
+
+# Number of cycles whose indices are fitted together. Each cycle in a batch
+# holds its global fields (~8 MB) until the batch is saved.
+INDICATOR_BATCH_SIZE = 16
+
+# ENSO grid parallelism: processes in the pool. 1 makes the grids in this process,
+# saving each in the background while the next one is made.
+ENSO_WORKERS = 1
\ No newline at end of file
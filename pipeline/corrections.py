@@ -0,0 +1,120 @@
+'''
+Per-mission additive SSHA corrections.
+
+Missions list correction tables under `corrections` in conf/datasets.yaml.
+Each table is a headerless CSV of date,value rows in meters. Tables are loaded
+once into sorted date/value arrays and looked up with searchsorted.
+
+Each table's path and checksum are recorded in the manifests of the gridded
+cycles with granules from its mission, so revising or adding a table regrids
+those cycles.
+'''
+import hashlib
+import logging
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import yaml
+
+
+def load_correction_table(path):
+    '''
+    Returns:
+        table (dict): name, path, checksum of the file, sorted datetime64[D]
+                      dates and their values
+    '''
+    with open(path, 'rb') as f:
+        checksum = hashlib.sha1(f.read()).hexdigest()
+
+    df = pd.read_csv(path, header=None, names=['date', 'value'])
+    dates = pd.to_datetime(df['date'], errors='coerce')
+
+    # Tolerate a header row, but nothing else unparsable
+    bad = dates.isna().to_numpy()
+    if bad[1:].any():
+        raise ValueError(f'Unparsable dates in correction table {path}: {df["date"][bad].tolist()}')
+
+    dates = dates[~bad].to_numpy().astype('datetime64[D]')
+    values = df['value'][~bad].to_numpy(dtype=np.float64)
+
+    order = np.argsort(dates, kind='stable')
+    return {
+        'name': path.split('/')[-1],
+        'path': path,
+        'checksum': checksum,
+        'dates': dates[order],
+        'values': values[order]
+    }
+
+
+@lru_cache()
+def load_corrections(config_path='conf/datasets.yaml'):
+    '''
+    Returns:
+        corrections (dict): mission name -> list of correction tables
+    '''
+    with open(config_path, "r") as stream:
+        config = yaml.load(stream, yaml.Loader)
+
+    return {c['ds_name']: [load_correction_table(path) for path in c['corrections']]
+            for c in config if c.get('corrections')}
+
+
+def lookup(table, date):
+    '''
+    Returns the table's value for date, or None if the date is missing
+    '''
+    date = np.datetime64(date, 'D')
+    i = np.searchsorted(table['dates'], date)
+    if i < len(table['dates']) and table['dates'][i] == date:
+        return table['values'][i]
+    return None
+
+
+def correction_params(missions):
+    '''
+    Manifest params recording the correction tables applied to the missions
+
+    Returns:
+        params (dict): mission -> list of table paths and checksums, only for
+                       missions with corrections
+    '''
+    corrections = load_corrections()
+    return {mission: [{'path': table['path'], 'checksum': table['checksum']} for table in corrections[mission]]
+            for mission in sorted(set(missions)) if mission in corrections}
+
+
+def log_missing_corrections(missions, dates):
+    '''
+    Logs one warning per mission and table for the dates the table has no
+    value for, ie: dates after the end of a table.
+
+    Params:
+        missions (list): mission of each granule
+        dates (list): YYYY-MM-DD date of each granule
+    '''
+    missions = np.asarray(missions)
+    dates = np.asarray(dates, 'datetime64[D]')
+
+    for mission, tables in load_corrections().items():
+        mission_dates = np.unique(dates[missions == mission])
+        for table in tables:
+            i = np.minimum(np.searchsorted(table['dates'], mission_dates), len(table['dates']) - 1)
+            missing = mission_dates[table['dates'][i] != mission_dates]
+            if len(missing):
+                logging.warning(f'No {table["name"]} correction for {mission} on {len(missing)} dates '
+                                f'between {missing[0]} and {missing[-1]}. Left uncorrected.')
+
+
+def apply_corrections(ssha, mission, date):
+    '''
+    Adds every configured correction for the mission to ssha in place.
+    Dates missing from a table are left uncorrected, see log_missing_corrections.
+    '''
+    for table in load_corrections().get(mission, []):
+        value = lookup(table, date)
+        if value is None:
+            logging.debug(f'No {table["name"]} correction for {mission} on {date}. Left uncorrected.')
+            continue
+        ssha += value
@@ -1,221 +1,269 @@
-from glob import glob
 import logging
 import os
 import warnings
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
 
 import numpy as np
 import xarray as xr
-import pandas as pd
-from netCDF4 import default_fillvals # pylint: disable=no-name-in-module
-import yaml
 
 with warnings.catch_warnings():
     warnings.simplefilter('ignore', UserWarning)
     import pyresample as pr
-    from pyresample.kd_tree import resample_gauss
-    from pyresample.utils import check_and_wrap
-
-from conf.global_settings import FILE_FORMAT, DATA_DIR, OUTPUT_DIR
-
-
-def collect_data(start, end):
-    def date_filter(f):
-        date = f.split('/')[-1].split('.')[0][-8:]
-        date = f'{date[:4]}-{date[4:6]}-{date[6:]}'
-        date = np.datetime64(date)
-
-        if date >= start and date <= end:
-            return True
-        return False
-    
-    def ref_filter(f):
-        '''
-        Removes MERGED_ALT granules
-        '''
-        return "MERGED_ALT" not in f
-    
-    def valid_sat(f):
-        if 'MERGED_ALT' in f:
-            return False
-        with open(f'conf/datasets.yaml', "r") as stream:
-            config = yaml.load(stream, yaml.Loader)
-        configs = {c['ds_name']: c for c in config}
-
-        ds_name = f.split('/')[-2]
-        if ds_name not in configs:
-            return False
-
-        start = configs.get(ds_name).get('start')
-        end = configs.get(ds_name).get('end')
-
-        date = f.split('/')[-1].split('.')[0][-8:]
-
-        if date >= start and date <= end:
-            return True
-        return False
-
-    # Get reference mission granules
-    ref_granules = glob(f'{DATA_DIR}/MERGED_ALT/*{FILE_FORMAT}')
-    ref_granules.sort()
-    ref_granules = filter(date_filter, ref_granules)
-
-    # Get other granules
-    other_granules = glob(f'{DATA_DIR}/**/*{FILE_FORMAT}')
-    other_granules.sort()
-
-    other_granules = filter(date_filter, other_granules)
-    other_granules = filter(ref_filter, other_granules)
-    other_granules = filter(valid_sat, other_granules)
-
-    cycle_granules = list(other_granules) + list(ref_granules)
-    cycle_granules = sorted(cycle_granules, key=lambda f: f.split('/')[-1].split('.')[0][3:])
+
+from conf.global_settings import (DATA_DIR, DEFAULT_GRIDDING_PROFILE, GRIDDED_CYCLE_FORMAT, GRIDDING_PREFETCH,
+                                  GRIDDING_PREFETCH_MAX_BYTES, GRIDDING_READERS, GRIDDING_THREADS,
+                                  GRIDDING_WORKERS, OUTPUT_DIR, OUTPUT_PENDING_WRITES)
+from corrections import apply_corrections, correction_params, log_missing_corrections
+from cycle_index import all_cycle_dates, cycle_window
+from granule_cache import read_granule
+from gridded_cycles import GRID_MASK_PATH, check_grid_format, compact_cycle, load_grid_reference
+from granule_catalog import (catalogued_cycles, clear_stale, connect, granule_date, granule_mission,
+                             granules_in_range, refresh, stale_cycles)
+from gridding_engines import get_engine, get_gridding_profile, lonlat_to_cartesian
+from manifest import is_stale, write_manifest
+from mission_windows import in_mission_window
+from output_writer import finished_writes, submit_write, write_netcdf
+
+
+def collect_data(catalog, start, end):
+    '''
+    Looks up the granules for a cycle in the granule catalog
+
+    Returns:
+        cycle_granules (list): catalog rows for the cycle's granules
+    '''
+    granules = granules_in_range(catalog, start, end)
+
+    # Reference mission granules are always used
+    ref_granules = [g for g in granules if g['mission'] == 'MERGED_ALT']
+
+    # Other granules must fall within their mission's window
+    other_granules = [g for g in granules if g['mission'] != 'MERGED_ALT']
+    valid = in_mission_window([g['mission'] for g in other_granules],
+                              [g['date'] for g in other_granules])
+    other_granules = [g for g, keep in zip(other_granules, valid) if keep]
+
+    cycle_granules = other_granules + ref_granules
+    cycle_granules = sorted(cycle_granules, key=lambda g: g['path'].split('/')[-1].split('.')[0][3:])
     return cycle_granules
 
 
-def check_updating(cycle_granules, date):
+def grid_path(date):
+    return f'{OUTPUT_DIR}/gridded_cycles/ssha_global_half_deg_{str(date).replace("-", "")}.nc'
+
+
+def granule_inputs(cycle_granules):
     '''
-    Compare local files
+    Manifest inputs for a cycle, using the catalogued size and mtime
     '''
+    return {os.path.relpath(g['path'], DATA_DIR): (g['path'], g['size'], g['mtime'])
+            for g in cycle_granules}
 
-    # Check if gridded cycle exists
-    grid_path = f'{OUTPUT_DIR}/gridded_cycles/ssha_global_half_deg_{str(date).replace("-", "")}.nc'
-    if not os.path.exists(grid_path):
-        return True
 
-    grid_mod_time = datetime.fromtimestamp(os.path.getmtime(grid_path))
-    # Check if individual granules have been updated
-    for granule in cycle_granules:
-        mod_time = datetime.fromtimestamp(os.path.getmtime(granule))
+def manifest_params(params, cycle_granules):
+    '''
+    Manifest params for a cycle: the gridding params, plus the correction
+    tables applied to its granules when any of its missions have some
+    '''
+    corrections = correction_params([g['mission'] for g in cycle_granules])
+    if not corrections:
+        return params
+    return dict(params, corrections=corrections)
 
-        if mod_time > grid_mod_time:
-            return True
 
-    return False
+def check_updating(cycle_granules, date, params):
+    '''
+    Checks the gridded cycle's manifest against the cycle's granules
+    '''
+    path = grid_path(date)
+
+    def mtime_check():
+        grid_mod_time = os.path.getmtime(path)
+        return any(granule['mtime'] > grid_mod_time for granule in cycle_granules)
+
+    return is_stale(path, granule_inputs(cycle_granules), manifest_params(params, cycle_granules),
+                    legacy_check=mtime_check)
 
 
-def apply_s6_correction(ds, filename):
-    df = pd.read_csv('ref_files/S6_radiometer_additive_correction.csv')
+def duplicate_mask(time, lats, lons, ssha):
+    '''
+    Flags points repeating an earlier point's time, lat, lon and SSHA. time
+    must be sorted, so repeats can only occur within runs of equal times. Only
+    the points in those runs are sorted by value, keeping the cost linear in
+    the size of the cycle.
+
+    Returns:
+        duplicates (ndarray): boolean mask, True for every repeat after the first
+    '''
+    duplicates = np.zeros(len(time), bool)
+    same_time = time[1:] == time[:-1]
+    if not same_time.any():
+        return duplicates
 
-    filename = filename.split('ssh')[-1].split('.')[0]
-    file_date = ''.join(filter(str.isdigit, filename))
+    in_run = np.zeros(len(time), bool)
+    in_run[1:] |= same_time
+    in_run[:-1] |= same_time
+    idx = np.flatnonzero(in_run)
 
-    try:
-        correction_value = float(df[df.index==file_date].value.values)
-    except:
-        correction_value = 0
+    # Time is the primary key, so runs stay contiguous with identical points
+    # next to each other. lexsort is stable, so the first occurrence is kept.
+    idx = idx[np.lexsort((ssha[idx], lons[idx], lats[idx], time[idx]))]
 
-    ds.SSHA.values = ds.SSHA.values + correction_value
+    def repeats(values):
+        values = values[idx]
+        return (values[1:] == values[:-1]) | (np.isnan(values[1:]) & np.isnan(values[:-1]))
 
-    return ds
+    repeat = (time[idx][1:] == time[idx][:-1]) & repeats(lats) & repeats(lons) & repeats(ssha)
+    duplicates[idx[1:][repeat]] = True
+    return duplicates
 
 
 def merge_granules(cycle_granules):
-    granules = []
-
-    for granule in cycle_granules:
-        ds = xr.open_dataset(granule, group='data')
-        ds = xr.Dataset(
-            data_vars=dict(
-                SSHA=(['time'], ds.ssh.values),
-                latitude=(['time'], ds.lats.values),
-                longitude=(['time'], ds.lons.values),
-                time=(['time'], ds.time.values)
-            )
+    '''
+    Reads the cycle's granules into preallocated contiguous arrays, merged in
+    time order with duplicate points removed, and wraps them in a single
+    Dataset. The number of points removed is kept in its duplicates_removed
+    attribute.
+    '''
+    arrs = [read_granule(granule) for granule in cycle_granules]
+    total = sum(len(arr) for arr in arrs)
+
+    time = np.empty(total, 'M8[ns]')
+    lats = np.empty(total)
+    lons = np.empty(total)
+    ssha = np.empty(total)
+
+    start = 0
+    for granule, arr in zip(cycle_granules, arrs):
+        stop = start + len(arr)
+        time[start:stop] = arr['time']
+        lats[start:stop] = arr['lat']
+        lons[start:stop] = arr['lon']
+        ssha[start:stop] = arr['ssha']
+
+        # Apply mission specific additive corrections, ie: Sentinel-6A radiometer
+        apply_corrections(ssha[start:stop], granule_mission(granule), granule_date(granule))
+
+        start = stop
+
+    # Each granule is already time ordered. A stable sort detects those runs
+    # and only has to merge them, and is skipped entirely if they don't overlap.
+    if np.any(time[1:] < time[:-1]):
+        order = np.argsort(time, kind='stable')
+        time, lats, lons, ssha = time[order], lats[order], lons[order], ssha[order]
+
+    # Overlapping deliveries, ie: MERGED_ALT and a per mission granule, can
+    # repeat points. Drop true duplicates so they aren't double weighted.
+    duplicates = duplicate_mask(time, lats, lons, ssha)
+    n_duplicates = int(np.count_nonzero(duplicates))
+    if n_duplicates:
+        keep = ~duplicates
+        time, lats, lons, ssha = time[keep], lats[keep], lons[keep], ssha[keep]
+
+    cycle_ds = xr.Dataset(
+        data_vars=dict(
+            SSHA=(['time'], ssha),
+            latitude=(['time'], lats),
+            longitude=(['time'], lons),
+            time=(['time'], time)
         )
+    )
+
+    cycle_ds.time.attrs = {
+        'long_name': 'time',
+        'standard_name': 'time',
+        'units': 'seconds since 1985-01-01',
+        'calendar': 'gregorian',
+    }
+
+    cycle_ds.latitude.attrs = {
+        'long_name': 'latitude',
+        'standard_name': 'latitude',
+        'units': 'degrees_north',
+        'comment': 'Positive latitude is North latitude, negative latitude is South latitude. FillValue pads the reference orbits to have same length'
+    }
+
+    cycle_ds.longitude.attrs = {
+        'long_name': 'longitude',
+        'standard_name': 'longitude',
+        'units': 'degrees_east',
+        'comment': 'East longitude relative to Greenwich meridian. FillValue pads the reference orbits to have same length'
+    }
+
+    cycle_ds.SSHA.attrs = {
+        'long_name': 'sea surface height anomaly',
+        'standard_name': 'sea_surface_height_above_sea_level',
+        'units': 'm',
+        'valid_min': np.nanmin(ssha),
+        'valid_max': np.nanmax(ssha),
+        'comment': 'Sea level determined from satellite altitude - range - all altimetric corrections',
+    }
+
+    cycle_ds.attrs['duplicates_removed'] = n_duplicates
 
-        ds.time.attrs = {
-            'long_name': 'time',
-            'standard_name': 'time',
-            'units': 'seconds since 1985-01-01',
-            'calendar': 'gregorian',
-        }
-
-        ds.latitude.attrs = {
-            'long_name': 'latitude',
-            'standard_name': 'latitude',
-            'units': 'degrees_north',
-            'comment': 'Positive latitude is North latitude, negative latitude is South latitude. FillValue pads the reference orbits to have same length'
-        }
-
-        ds.longitude.attrs = {
-            'long_name': 'longitude',
-            'standard_name': 'longitude',
-            'units': 'degrees_east',
-            'comment': 'East longitude relative to Greenwich meridian. FillValue pads the reference orbits to have same length'
-        }
-
-        ds.SSHA.attrs = {
-            'long_name': 'sea surface height anomaly',
-            'standard_name': 'sea_surface_height_above_sea_level',
-            'units': 'm',
-            'valid_min': np.nanmin(ds.SSHA.values),
-            'valid_max': np.nanmax(ds.SSHA.values),
-            'comment': 'Sea level determined from satellite altitude - range - all altimetric corrections',
-        }
-
-        # Apply temporary sentinel 6A corrections
-        if 'SNTNL-6A' in granule:
-            ds = apply_s6_correction(ds, granule)
-
-        # Check for duplicate time values. Drop if they are true duplicates
-        # all_times = ds.time.values
-        # seen = set()
-        # seen_add = seen.add
-        # seen_twice = list(x for x in all_times if x in seen or seen_add(x))
-        # if seen_twice:
-        #     _, index = np.unique(ds['time'], return_index=True)
-        #     ds = ds.isel(time=index)
-
-        granules.append(ds)
-
-    cycle_ds = xr.concat((granules), dim='time', data_vars="all") if len(granules) > 1 else granules[0]
-    cycle_ds = cycle_ds.sortby('time')
     return cycle_ds
 
 
-def gauss_grid(ssha_nn_obj, global_obj, params):
+@lru_cache()
+def load_target_grid(mask_path=GRID_MASK_PATH):
+    '''
+    Builds the 0.5 degree target grid once per process. Pool workers forked
+    after it is built share it, so its arrays are made read-only.
 
-    tmp_ssha_lons, tmp_ssha_lats = check_and_wrap(ssha_nn_obj['lon'].ravel(),
-                                                  ssha_nn_obj['lat'].ravel())
+    Returns:
+        target (dict): the grid reference (1D lon/lat, the wet/dry mask, 2D
+                       shape and flat indices of wet cells) with the wet
+                       cells' lon/lat, cartesian coordinates and pyresample
+                       swath
+    '''
+    target = dict(load_grid_reference(mask_path))
 
-    ssha_grid = pr.geometry.SwathDefinition(lons=tmp_ssha_lons, lats=tmp_ssha_lats)
-    new_vals, _, counts = resample_gauss(ssha_grid, ssha_nn_obj['ssha'],
-                                         global_obj['swath'], params['roi'], 
-                                         params['sigma'], params['neighbours'], 
-                                         fill_value=np.NaN, nprocs=4, with_uncert=True)
+    global_lon_m, global_lat_m = np.meshgrid(target['lon'], target['lat'])
+    target_lons_wet = global_lon_m.ravel()[target['wet']]
+    target_lats_wet = global_lat_m.ravel()[target['wet']]
 
-    new_vals_2d = np.full_like(global_obj['ds'].maskC.isel(Z=0).values, np.nan, np.double)
-    for i, val in enumerate(new_vals):
-        new_vals_2d.ravel()[global_obj['wet'][i]] = val
+    target['lons_wet'] = target_lons_wet
+    target['lats_wet'] = target_lats_wet
+    target['xyz'] = lonlat_to_cartesian(target_lons_wet, target_lats_wet)
+    for key in ['lons_wet', 'lats_wet', 'xyz']:
+        target[key].setflags(write=False)
 
-    counts_2d = np.full_like(global_obj['ds'].maskC.isel(Z=0).values, np.nan, np.double)
-    for i, val in enumerate(counts):
-        counts_2d.ravel()[global_obj['wet'][i]] = val
-    return new_vals_2d, counts_2d
+    target['swath'] = pr.geometry.SwathDefinition(lons=target_lons_wet,
+                                                  lats=target_lats_wet)
+    return target
 
 
-def gridding(cycle_ds, date, sources):
-    # Prepare global map
-    global_ds = xr.open_dataset('ref_files/UPDATED_GRID_MASK_latlon.nc')
+@lru_cache()
+def grid_buffers(shape):
+    '''
+    SSHA and counts planes reused by every cycle gridded in this process.
+    Dry cells are NaN once and for all, wet cells are overwritten each cycle,
+    so anything built on these planes is only valid until the next cycle is
+    gridded.
+    '''
+    return np.full((2,) + shape, np.nan, np.double)
+
 
-    wet_ins = np.where(global_ds.maskC.isel(Z=0).values.ravel() > 0)[0]
+def gauss_grid(ssha_nn_obj, global_obj, params, nprocs=GRIDDING_THREADS):
+    engine = get_engine(params['engine'])['function']
+    new_vals, counts = engine(ssha_nn_obj['lon'].ravel(), ssha_nn_obj['lat'].ravel(),
+                              ssha_nn_obj['ssha'], global_obj, params, nprocs)
 
-    global_lon = global_ds.longitude.values
-    global_lat = global_ds.latitude.values
+    # Scatter the wet cell results into the 2D planes in one pass
+    planes = grid_buffers(global_obj['shape'])
+    planes.reshape(2, -1)[:, global_obj['wet']] = (new_vals, counts)
 
-    global_lon_m, global_lat_m = np.meshgrid(global_lon, global_lat)
-    target_lons_wet = global_lon_m.ravel()[wet_ins]
-    target_lats_wet = global_lat_m.ravel()[wet_ins]
+    new_vals_2d, counts_2d = planes
+    return new_vals_2d, counts_2d
 
-    global_swath_def = pr.geometry.SwathDefinition(lons=target_lons_wet,
-                                                   lats=target_lats_wet)
 
-    global_obj = {
-        'swath': global_swath_def,
-        'ds': global_ds,
-        'wet': wet_ins
-    }
+def gridding(cycle_ds, date, sources, params, nprocs=GRIDDING_THREADS):
+    # Prepare global map
+    global_obj = load_target_grid()
+    global_lon = global_obj['lon']
+    global_lat = global_obj['lat']
 
     # Define the 'swath' as the lats/lon pairs of the model grid
     ssha_lon = cycle_ds.longitude.values.ravel()
@@ -232,14 +280,8 @@ def gridding(cycle_ds, date, sources):
         'ssha': ssha_nn
     }
 
-    params = {
-        'roi': 6e5,  # 6e5
-        'sigma': 1e5,
-        'neighbours': 500  # 500 for production, 10 for development
-    }
-
     if np.sum(~np.isnan(ssha_nn)) > 0:
-        new_vals, counts = gauss_grid(ssha_nn_obj, global_obj, params)
+        new_vals, counts = gauss_grid(ssha_nn_obj, global_obj, params, nprocs)
     else:
         raise ValueError('No ssha values.')
 
@@ -261,7 +303,7 @@ def gridding(cycle_ds, date, sources):
 
     gridded_ds['counts'] = counts_da
 
-    gridded_ds['mask'] = (['latitude', 'longitude'], np.where(global_ds['maskC'].isel(Z=0) == True, 1, 0))
+    gridded_ds['mask'] = (['latitude', 'longitude'], global_obj['mask'])
 
     gridded_ds['mask'].attrs = {'long_name': 'wet/dry boolean mask for grid cell',
                                 'comment': '1 for ocean, otherwise 0'}
@@ -275,7 +317,7 @@ def gridding(cycle_ds, date, sources):
         'valid_min': np.nanmin(counts_da.values),
         'valid_max': np.nanmax(counts_da.values),
         'long_name': 'number of data values used in weighting each element in SSHA',
-        'source': 'Returned from pyresample resample_gauss function.'
+        'source': f'Returned from {get_engine(params["engine"])["description"]} function.'
     }
 
     gridded_ds['latitude'].attrs = cycle_ds['latitude'].attrs
@@ -289,91 +331,258 @@ def gridding(cycle_ds, date, sources):
         'comment': 'seconds since 1970-01-01 00:00:00'
     }
 
+    gridded_ds.attrs['gridding_profile'] = params['profile']
+    gridded_ds.attrs['gridding_neighbours'] = params['neighbours']
     gridded_ds.attrs['gridding_method'] = \
-        f'Gridded using pyresample resample_gauss with roi={params["roi"]}, neighbours={params["neighbours"]}'
+        f'Gridded using {get_engine(params["engine"])["description"]} with roi={params["roi"]}, neighbours={params["neighbours"]}'
 
     gridded_ds.attrs['source'] = 'Combination of ' + ', '.join(sources) + ' along track instruments'
 
     return gridded_ds
 
 
-def cycle_ds_encoding(cycle_ds):
-    """
-    Generates encoding dictionary used for saving the cycle netCDF file.
-    The measures gridded dataset (1812) has additional units encoding requirements.
+def cycles_to_process(catalog):
+    '''
+    Cycles that need to be (re)gridded: those marked stale by the granule
+    catalog plus any catalogued cycle without a gridded output yet.
+    '''
+    grid_dir = f'{OUTPUT_DIR}/gridded_cycles'
+    existing = set(os.listdir(grid_dir)) if os.path.exists(grid_dir) else set()
+
+    missing = [date for date in catalogued_cycles(catalog)
+               if os.path.basename(grid_path(date)) not in existing]
 
-    Params:
-        cycle_ds (Dataset): the Dataset object
-        ds_name (str): the name of the dataset (used to check if dataset is 1812)
-        center_date (datetime): used to set the units encoding in the 1812 dataset
+    dates = np.union1d(stale_cycles(catalog), np.array(missing, dtype='datetime64[D]'))
+    return np.intersect1d(dates, all_cycle_dates())
+
+
+def read_cycle(date, cycle_granules):
+    '''
+    Merges a cycle's granules. Thread safe, so it can run ahead of gridding.
 
     Returns:
-        encoding (dict): the encoding dictionary for the cycle_ds Dataset object
-    """
+        cycle_ds (Dataset): the merged along track data
+        sources (list): the missions contributing to the cycle
+    '''
+    logging.debug(f'\tMerging granules for {date} cycle')
+    cycle_ds = merge_granules([g['path'] for g in cycle_granules])
+    sources = list(set([g['mission'] for g in cycle_granules]))
+    logging.info(f'\tRemoved {cycle_ds.attrs["duplicates_removed"]} duplicate points from {date} cycle')
+    return cycle_ds, sources
 
-    var_encoding = {'zlib': True,
-                    'complevel': 5,
-                    'dtype': 'float32',
-                    'shuffle': True,
-                    '_FillValue': default_fillvals['f8']}
-    var_encodings = {var: var_encoding for var in cycle_ds.data_vars}
 
-    coord_encoding = {}
-    for coord in cycle_ds.coords:
-        if 'Time' in coord:
-            coord_encoding[coord] = {'_FillValue': None,
-                                     'zlib': True,
-                                     'contiguous': False,
-                                     'shuffle': False}
+def make_grid_dir():
+    grid_dir = f'{OUTPUT_DIR}/gridded_cycles'
+    os.makedirs(grid_dir, exist_ok=True)
+    os.chmod(grid_dir, 0o777)
 
-        if 'Lat' in coord or 'Lon' in coord:
-            coord_encoding[coord] = {'_FillValue': None, 'dtype': 'float32'}
 
-    encoding = {**coord_encoding, **var_encodings}
-    return encoding
+def cycle_output(gridded_ds, grid_format=GRIDDED_CYCLE_FORMAT, copy=False):
+    '''
+    The Dataset saved for a gridded cycle in grid_format, full or compact
+    (see gridded_cycles). gridding reuses its output planes, so pass copy
+    when the save is deferred. Compact cycles are always new arrays.
+    '''
+    check_grid_format(grid_format)
+    if grid_format == 'compact':
+        return compact_cycle(gridded_ds, load_target_grid())
+    return gridded_ds.copy(deep=True) if copy else gridded_ds
 
 
-def cycle_gridding():
-    ALL_DATES = np.arange('1992-10-05', 'now', 7, dtype='datetime64[D]')
+def write_cycle(gridded_ds, date, cycle_granules, params, grid_format=GRIDDED_CYCLE_FORMAT):
+    '''
+    Saves a gridded cycle and records its manifest
+    '''
+    make_grid_dir()
+    filepath = grid_path(date)
+    write_netcdf(cycle_output(gridded_ds, grid_format), filepath)
+    write_manifest(filepath, granule_inputs(cycle_granules), manifest_params(params, cycle_granules))
 
-    failed_grids = []
 
-    for date in ALL_DATES:
-        cycle_start = date - np.timedelta64(5, 'D')
-        cycle_end = cycle_start + np.timedelta64(9, 'D')
+def submit_cycle(gridded_ds, date, cycle_granules, params, grid_format=GRIDDED_CYCLE_FORMAT):
+    '''
+    Queues a gridded cycle to be saved by the output writer, recording its
+    manifest once written.
 
-        try:
-            cycle_granules = collect_data(cycle_start, cycle_end)
+    Returns:
+        future (Future): resolves once the cycle is saved
+    '''
+    make_grid_dir()
+    filepath = grid_path(date)
+    return submit_write(cycle_output(gridded_ds, grid_format, copy=True), filepath,
+                        after=partial(write_manifest, filepath, granule_inputs(cycle_granules),
+                                      manifest_params(params, cycle_granules)))
 
-            if not cycle_granules or not check_updating(cycle_granules, date):
-                logging.info(f'No update needed for {date} cycle')
-                continue
+
+def grid_cycle(date, cycle_granules, params, nprocs=GRIDDING_THREADS, grid_format=GRIDDED_CYCLE_FORMAT):
+    '''
+    Merges, grids and saves a single cycle. Runs in pool workers when
+    gridding in parallel, so everything it takes must be picklable.
+    '''
+    logging.info(f'Processing {date} cycle')
+    cycle_ds, sources = read_cycle(date, cycle_granules)
+
+    logging.debug(f'\tGridding {date} cycle...')
+    gridded_ds = gridding(cycle_ds, date, sources, params, nprocs)
+    logging.debug(f'\tGridding {date} cycle complete.')
+
+    write_cycle(gridded_ds, date, cycle_granules, params, grid_format)
+
+
+def stream_cycles(jobs, params, nprocs=GRIDDING_THREADS, prefetch=GRIDDING_PREFETCH, readers=GRIDDING_READERS,
+                  max_bytes=GRIDDING_PREFETCH_MAX_BYTES, max_pending_writes=OUTPUT_PENDING_WRITES,
+                  grid_format=GRIDDED_CYCLE_FORMAT):
+    '''
+    Grids jobs in order in this process, overlapping I/O with gridding.
+    Reader threads merge up to prefetch cycles ahead of the one being gridded
+    and the output writer pool saves gridded cycles.
+
+    Readers stop getting ahead once the merged cycles waiting to be gridded
+    hold max_bytes, though at least one cycle is always read ahead. Gridding
+    waits once max_pending_writes cycles are waiting to be saved.
+
+    Params:
+        jobs (list): (date, cycle_granules) pairs to grid
+        params (dict): gridding profile params
+        nprocs (int): threads used by the gridding engine
+        prefetch (int): maximum number of cycles read ahead, at least 1
+        grid_format (str): format the gridded cycles are saved in
+
+    Yields:
+        (date, error): for each job once it is saved or has failed. error is
+                       None on success.
+    '''
+    jobs = iter(jobs)
+    reads = deque()
+    writes = deque()
+
+    def prefetched_bytes():
+        return sum(future.result()[0].nbytes for _, future in reads
+                   if future.done() and future.exception() is None)
+
+    with ThreadPoolExecutor(max_workers=readers) as read_pool:
+
+        def read_ahead():
+            while len(reads) < max(prefetch, 1) and (not reads or prefetched_bytes() < max_bytes):
+                job = next(jobs, None)
+                if job is None:
+                    return
+                reads.append((job, read_pool.submit(read_cycle, *job)))
+
+        read_ahead()
+        while reads:
+            (date, cycle_granules), future = reads.popleft()
+            read_ahead()
 
             logging.info(f'Processing {date} cycle')
-            logging.debug(f'\tMerging granules for {date} cycle')
-            cycle_ds = merge_granules(cycle_granules)
-            sources = list(set([g.split('/')[-2].split('/')[0] for g in cycle_granules]))
+            try:
+                cycle_ds, sources = future.result()
+                logging.debug(f'\tGridding {date} cycle...')
+                gridded_ds = gridding(cycle_ds, date, sources, params, nprocs)
+                logging.debug(f'\tGridding {date} cycle complete.')
+
+                writes.append((date, submit_cycle(gridded_ds, date, cycle_granules, params, grid_format)))
+                del cycle_ds, gridded_ds
+            except Exception as e:
+                yield date, e
+
+            yield from finished_writes(writes, max_pending_writes)
+
+        yield from finished_writes(writes)
+
+
+def cycle_gridding(full_scan=False, workers=GRIDDING_WORKERS, threads=GRIDDING_THREADS,
+                   profile=DEFAULT_GRIDDING_PROFILE, prefetch=GRIDDING_PREFETCH, grid_format=GRIDDED_CYCLE_FORMAT):
+    '''
+    Grids the cycles affected by new, modified or removed granules. When
+    full_scan is True every cycle since 1992 is checked instead.
+
+    Cycles are independent, so with workers > 1 they are handed to a process
+    pool, each worker using threads for the resampling itself. Otherwise with
+    prefetch > 0 cycles are streamed, merging the next prefetch cycles and
+    saving finished ones in background threads while the current one is
+    gridded.
+
+    profile names the set of gridding params in conf/gridding_profiles.yaml
+    to grid with. Params are recorded in each grid's manifest, so switching
+    profiles with full_scan regrids every cycle.
+
+    grid_format sets whether cycles are saved as full planes or compact
+    wet cell vectors. It isn't recorded in manifests, since readers load
+    both formats, so existing cycles keep their format until regridded.
+    '''
+    failed_grids = []
+
+    params = get_gridding_profile(profile)
+    check_grid_format(grid_format)
+
+    catalog = connect()
+    refresh(catalog)
+
+    if full_scan:
+        cycle_dates = all_cycle_dates()
+    else:
+        cycle_dates = cycles_to_process(catalog)
+        logging.info(f'{len(cycle_dates)} cycles affected by granule changes')
 
-            logging.debug(f'\tGridding {date} cycle...')
-            gridded_ds = gridding(cycle_ds, date, sources)
-            logging.debug(f'\tGridding {date} cycle complete.')
+    # Determine which cycles actually need gridding
+    jobs = []
+    for date in cycle_dates:
+        cycle_start, cycle_end = cycle_window(date)
 
-            # Save the gridded cycle
-            encoding = cycle_ds_encoding(gridded_ds)
+        try:
+            cycle_granules = collect_data(catalog, cycle_start, cycle_end)
 
-            grid_dir = f'{OUTPUT_DIR}/gridded_cycles'
-            os.makedirs(grid_dir, exist_ok=True)
-            os.chmod(grid_dir, 0o777)
-            filename = f'ssha_global_half_deg_{str(date).replace("-", "")}.nc'
-            filepath = f'{grid_dir}/{filename}'
+            if not cycle_granules or not check_updating(cycle_granules, date, params):
+                logging.info(f'No update needed for {date} cycle')
+                clear_stale(catalog, date)
+                continue
 
-            gridded_ds.to_netcdf(filepath, encoding=encoding)
+            jobs.append((date, cycle_granules))
 
         except Exception as e:
             failed_grids.append(date)
             logging.exception(f'\nError while processing cycle {date}. {e}')
 
+    # Warn about missing corrections once per run rather than per granule
+    job_granules = [g for _, cycle_granules in jobs for g in cycle_granules]
+    log_missing_corrections([g['mission'] for g in job_granules], [g['date'] for g in job_granules])
+
+    if workers > 1 and len(jobs) > 1:
+        # Build the target grid before forking so workers inherit it
+        load_target_grid()
+        logging.info(f'Gridding {len(jobs)} cycles across {workers} workers with {threads} threads each')
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(grid_cycle, date, cycle_granules, params, threads, grid_format): date
+                       for date, cycle_granules in jobs}
+            for future in as_completed(futures):
+                date = futures[future]
+                e = future.exception()
+                if e is None:
+                    clear_stale(catalog, date)
+                else:
+                    failed_grids.append(date)
+                    logging.error(f'\nError while processing cycle {date}. {e}', exc_info=e)
+    elif prefetch > 0:
+        for date, e in stream_cycles(jobs, params, threads, prefetch, grid_format=grid_format):
+            if e is None:
+                clear_stale(catalog, date)
+            else:
+                failed_grids.append(date)
+                logging.error(f'\nError while processing cycle {date}. {e}', exc_info=e)
+    else:
+        for date, cycle_granules in jobs:
+            try:
+                grid_cycle(date, cycle_granules, params, threads, grid_format)
+                clear_stale(catalog, date)
+            except Exception as e:
+                failed_grids.append(date)
+                logging.exception(f'\nError while processing cycle {date}. {e}')
+
+    catalog.close()
+
     if failed_grids:
-        logging.info(f'{len(failed_grids)} grids failed. Check logs')
+        failed_grids.sort()
+        logging.info(f'{len(failed_grids)} grids failed: {", ".join(str(date) for date in failed_grids)}. Check logs')
 
     return
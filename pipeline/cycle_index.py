@@ -0,0 +1,64 @@
+'''
+The weekly cycle grid and the granule -> cycle dependency index.
+
+Cycles are centered every 7 days from 1992-10-05 and each one uses granules
+dated from 5 days before to 4 days after its center date, so every granule
+date falls into one or two overlapping cycle windows.
+'''
+import numpy as np
+
+CYCLE_ORIGIN = np.datetime64('1992-10-05', 'D')
+CYCLE_STEP = 7
+WINDOW_BEFORE = 5
+WINDOW_AFTER = 4
+
+
+def all_cycle_dates():
+    return np.arange(CYCLE_ORIGIN, np.datetime64('now', 'D'), CYCLE_STEP, dtype='datetime64[D]')
+
+
+def cycle_window(date):
+    '''
+    Returns the inclusive (start, end) granule dates used by a cycle
+    '''
+    cycle_start = date - np.timedelta64(WINDOW_BEFORE, 'D')
+    cycle_end = cycle_start + np.timedelta64(WINDOW_BEFORE + WINDOW_AFTER, 'D')
+    return cycle_start, cycle_end
+
+
+def cycles_for_dates(dates):
+    '''
+    Maps granule dates to the cycles whose windows contain them
+
+    Params:
+        dates (array-like): granule dates, coercible to datetime64[D]
+
+    Returns:
+        cycle_dates (ndarray): sorted, unique datetime64[D] cycle center dates
+    '''
+    days = (np.asarray(dates, dtype='datetime64[D]') - CYCLE_ORIGIN).astype(int)
+
+    # A cycle k covers granule days [7k - 5, 7k + 4]
+    first = -((WINDOW_AFTER - days) // CYCLE_STEP)
+    last = (days + WINDOW_BEFORE) // CYCLE_STEP
+
+    ks = np.concatenate([first, first + 1])
+    ks = ks[ks <= np.concatenate([last, last])]
+    ks = np.unique(ks[ks >= 0])
+
+    cycle_dates = CYCLE_ORIGIN + ks * np.timedelta64(CYCLE_STEP, 'D')
+    return cycle_dates[cycle_dates < np.datetime64('now', 'D')]
+
+
+def cycle_slot(date):
+    '''
+    Position of a cycle on the cycle grid, counted from CYCLE_ORIGIN
+    '''
+    days = int((np.datetime64(date, 'D') - CYCLE_ORIGIN).astype(int))
+    if days < 0 or days % CYCLE_STEP:
+        raise ValueError(f'{date} is not a cycle center date')
+    return days // CYCLE_STEP
+
+
+def slot_date(slot):
+    return CYCLE_ORIGIN + np.timedelta64(int(slot) * CYCLE_STEP, 'D')
@@ -0,0 +1,147 @@
+'''
+Chunked netCDF time series with one time slot per cycle.
+
+A store keeps every cycle of a product in a single file. Slot i along the
+unlimited time dimension is the i-th cycle of the weekly cycle grid, so a
+cycle always lands in the same slot and reprocessing it overwrites only that
+slot. The `filled` variable flags the slots that have been written and
+open_store hides the rest.
+
+Variables are chunked along time and space, so reading a region across every
+cycle, or a single cycle, only touches the chunks it needs.
+'''
+import os
+
+import netCDF4
+import numpy as np
+import xarray as xr
+from netCDF4 import default_fillvals  # pylint: disable=no-name-in-module
+
+from conf.global_settings import OUTPUT_CODEC, OUTPUT_COMPLEVEL
+from cycle_index import cycle_slot, slot_date
+from granule_cache import HDF5_LOCK
+from output_writer import compression_encoding
+
+TIME_UNITS = 'seconds since 1970-01-01'
+
+
+def netcdf_type(dtype):
+    dtype = np.dtype(dtype)
+    return f'{dtype.kind}{dtype.itemsize}'
+
+
+def create_store(path, template, static=None, chunks=None, attrs=None,
+                 codec=OUTPUT_CODEC, complevel=OUTPUT_COMPLEVEL):
+    '''
+    Creates an empty store.
+
+    Params:
+        path (str): the store's path
+        template (Dataset): a single cycle of the product, without time. Its
+                            data variables get a leading time dimension and
+                            keep their dtype and attrs. Its dimension
+                            coordinates are written once.
+        static (dict): name -> DataArray written once, ie: a mask
+        chunks (dict): dimension -> chunk size, time included
+        attrs (dict): global attributes
+    '''
+    chunks = chunks or {}
+    compression = compression_encoding(codec, complevel)
+    tmp_path = f'{path}.tmp'
+
+    with HDF5_LOCK, netCDF4.Dataset(tmp_path, 'w') as nc:
+        nc.createDimension('time', None)
+        for dim, size in template.sizes.items():
+            nc.createDimension(dim, size)
+
+        time = nc.createVariable('time', 'i8', ('time',))
+        time.setncatts({'long_name': 'time', 'standard_name': 'time',
+                        'units': TIME_UNITS, 'calendar': 'proleptic_gregorian'})
+
+        filled = nc.createVariable('filled', 'i1', ('time',), fill_value=0)
+        filled.setncatts({'long_name': 'slot holds a cycle',
+                          'comment': '1 for slots written with a cycle, otherwise 0'})
+
+        for name in template.dims:
+            coord = template[name]
+            var = nc.createVariable(name, netcdf_type(coord.dtype), (name,))
+            var.setncatts(coord.attrs)
+            var[:] = coord.values
+
+        for name, da in (static or {}).items():
+            var = nc.createVariable(name, netcdf_type(da.dtype), da.dims, shuffle=True, **compression)
+            var.setncatts(da.attrs)
+            var[:] = da.values
+
+        for name, da in template.data_vars.items():
+            dims = ('time',) + da.dims
+            sizes = (chunks.get('time', 1),) + tuple(min(chunks.get(dim, size), size)
+                                                     for dim, size in zip(da.dims, da.shape))
+            nc_type = netcdf_type(da.dtype)
+            var = nc.createVariable(name, nc_type, dims, chunksizes=sizes, shuffle=True,
+                                    fill_value=default_fillvals[nc_type], **compression)
+            var.setncatts(da.attrs)
+
+        nc.setncatts(attrs or {})
+
+    os.replace(tmp_path, path)
+
+
+def write_slot(path, date, values):
+    '''
+    Writes one cycle into its slot, extending the time dimension if needed.
+
+    Params:
+        path (str): the store's path
+        date (datetime64): the cycle's center date
+        values (dict): data variable name -> the cycle's values
+    '''
+    slot = cycle_slot(date)
+
+    with HDF5_LOCK, netCDF4.Dataset(path, 'a') as nc:
+        n_slots = len(nc.dimensions['time'])
+        if slot >= n_slots:
+            new_dates = np.array([slot_date(i) for i in range(n_slots, slot + 1)], 'datetime64[s]')
+            nc['time'][n_slots:slot + 1] = new_dates.astype('int64')
+
+        for name, value in values.items():
+            nc[name][slot] = value
+        nc['filled'][slot] = 1
+
+
+def clear_slot(path, date):
+    '''
+    Marks a cycle's slot as empty, ie: when the cycle no longer belongs in the
+    product. Its values are left to be overwritten.
+    '''
+    slot = cycle_slot(date)
+
+    with HDF5_LOCK, netCDF4.Dataset(path, 'a') as nc:
+        if slot < len(nc.dimensions['time']):
+            nc['filled'][slot] = 0
+
+
+def slot_values(path, name):
+    '''
+    Reads a per cycle scalar for every filled slot
+
+    Returns:
+        values (dict): cycle date -> value
+    '''
+    with HDF5_LOCK, netCDF4.Dataset(path, 'r') as nc:
+        filled = np.flatnonzero(nc['filled'][:].filled(0) == 1)
+        values = nc[name][:][filled]
+    return {slot_date(slot): value for slot, value in zip(filled, values)}
+
+
+def open_store(path):
+    '''
+    Lazily opens the filled slots of a store. Nothing is read until values
+    are used, so selecting a region or time range first reads only that.
+
+    Returns:
+        ds (Dataset): the store's variables along time
+    '''
+    ds = xr.open_dataset(path)
+    filled = np.flatnonzero(ds['filled'].values == 1)
+    return ds.isel(time=filled).drop_vars('filled')
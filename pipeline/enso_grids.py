@@ -1,28 +1,29 @@
+import logging
 import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
-from netCDF4 import default_fillvals  # pylint: disable=no-name-in-module
+from functools import partial
 
 import numpy as np
 import xarray as xr
-from conf.global_settings import OUTPUT_DIR
+from conf.global_settings import ENSO_WORKERS, OUTPUT_DIR, OUTPUT_PENDING_WRITES
 from glob import glob
 import os
 
-warnings.filterwarnings('ignore')
-
-seas_ds = xr.open_dataset('ref_files/trnd_seas_simple_grid.nc')
-seas_ds.coords['Longitude'] = (seas_ds.coords['Longitude']) % 360
-seas_ds = seas_ds.sortby(seas_ds.Longitude)
+from gridded_cycles import gridding_neighbours, load_gridded_cycle
+from manifest import is_stale, stat_inputs, write_manifest
+from output_writer import finished_writes, submit_write, write_netcdf
+from ref_data import hr_mask, seasonal_cycle
 
-front_seas_ds = seas_ds.isel(Month_grid=0)
-back_seas_ds = seas_ds.isel(Month_grid=-1)
-front_seas_ds = front_seas_ds.assign_coords({'Month_grid': front_seas_ds.Month_grid.values + (12/12)})
-back_seas_ds = back_seas_ds.assign_coords({'Month_grid': back_seas_ds.Month_grid.values - (12/12)})
-padded_seas_ds = xr.concat([back_seas_ds, seas_ds, front_seas_ds], dim='Month_grid')
+warnings.filterwarnings('ignore')
 
-hr_mask_ds = xr.open_dataset('ref_files/HR_GRID_MASK_latlon.nc')
-hr_mask_ds.coords['longitude'] = hr_mask_ds.coords['longitude'] % 360
-hr_mask_ds = hr_mask_ds.sortby(hr_mask_ds.longitude)
+# Recorded in each ENSO grid's manifest. Changing them marks every grid stale.
+ENSO_PARAMS = {
+    'boxcar': {'longitude': 38, 'latitude': 16},
+    # Fraction of the cycle's gridding neighbours a smoothed cell must count
+    'min_counts': 0.95
+}
 
 def get_decimal_year(dt: datetime):
     year_start = datetime(dt.year, 1, 1)
@@ -37,16 +38,17 @@ def interp(ds: xr.Dataset) -> xr.Dataset:
     return interp_ds
 
 
-def smoothing(ds):
+def smoothing(ds, min_counts):
     # interpolation
     interp_ds = interp(ds)
 
     # Do boxcar averaging
-    dsr = interp_ds.rolling({'longitude':38, 'latitude':16}, min_periods=1, center=True).mean()
+    dsr = interp_ds.rolling(ENSO_PARAMS['boxcar'], min_periods=1, center=True).mean()
     dsr = dsr.sel(longitude=slice(0,360))
+    hr_mask_ds = hr_mask()
     
     dsr.SSHA.values = np.where(hr_mask_ds.maskC.values == 0, np.nan, dsr.SSHA.values)
-    filtered_ds = dsr.where(dsr.counts > 475, np.nan)
+    filtered_ds = dsr.where(dsr.counts > min_counts, np.nan)
     filtered_ds.SSHA.values = np.where(hr_mask_ds.maskC.values == 0, np.nan, filtered_ds.SSHA.values)
 
     dsr_subset = filtered_ds.sel(latitude=slice(-82,82))
@@ -56,6 +58,7 @@ def smoothing(ds):
 def remove_trends(data, date):
     decimal_year = get_decimal_year(date)
     yr_fraction = decimal_year - date.year
+    seas_ds, padded_seas_ds = seasonal_cycle()
 
     cycle_ds = padded_seas_ds.interp({'Month_grid': yr_fraction})
     removed_cycle_data = data - (cycle_ds.Seasonal_SSH.values * 10)
@@ -71,41 +74,6 @@ def padding(ds):
     padded_ds = xr.merge([back, ds, front])
     return padded_ds
 
-def cycle_ds_encoding(cycle_ds):
-    """
-    Generates encoding dictionary used for saving the cycle netCDF file.
-    The measures gridded dataset (1812) has additional units encoding requirements.
-
-    Params:
-        cycle_ds (Dataset): the Dataset object
-        ds_name (str): the name of the dataset (used to check if dataset is 1812)
-        center_date (datetime): used to set the units encoding in the 1812 dataset
-
-    Returns:
-        encoding (dict): the encoding dictionary for the cycle_ds Dataset object
-    """
-
-    var_encoding = {'zlib': True,
-                    'complevel': 5,
-                    'dtype': 'float32',
-                    'shuffle': True,
-                    '_FillValue': default_fillvals['f8']}
-    var_encodings = {var: var_encoding for var in cycle_ds.data_vars}
-
-    coord_encoding = {}
-    for coord in cycle_ds.coords:
-        if 'Time' in coord:
-            coord_encoding[coord] = {'_FillValue': None,
-                                     'zlib': True,
-                                     'contiguous': False,
-                                     'shuffle': False}
-
-        if 'Lat' in coord or 'Lon' in coord:
-            coord_encoding[coord] = {'_FillValue': None, 'dtype': 'float32'}
-
-    encoding = {**coord_encoding, **var_encodings}
-    return encoding
-
 def make_grid(ds):
     # ds.coords['longitude'] = (ds.coords['longitude']) % 360
     # ds = ds.sortby(ds.longitude)
@@ -133,14 +101,10 @@ def make_grid(ds):
 
     # fname = f'ssha_enso_{date_str}.nc'
     # smooth_ds.to_netcdf(f'{OUTPUT_DIR}/ENSO_grids/{fname}', encoding=encoding)
-    fname = f'ssha_enso_{datetime.strftime(date, "%Y%m%d")}.nc'
-    if os.path.exists(f'{OUTPUT_DIR}/ENSO_grids/{fname}'):
-        print('ENSO grid already exists. Skipping.')
-        return
-    
+    min_counts = ENSO_PARAMS['min_counts'] * gridding_neighbours(ds)
     ds.coords['longitude'] = (ds.coords['longitude']) % 360
     ds = ds.sortby(ds.longitude)
-    ds = ds.where(ds.counts > 475, np.nan)
+    ds = ds.where(ds.counts > min_counts, np.nan)
 
     lats = ds.latitude.values
     lons = ds.longitude.values
@@ -149,9 +113,11 @@ def make_grid(ds):
     date = datetime.utcfromtimestamp(ds.time.values.tolist()/1e9)
 
     date_str = datetime.strftime(date, '%b %d %Y')
+    fname = f'ssha_enso_{datetime.strftime(date, "%Y%m%d")}.nc'
 
     decimal_year = get_decimal_year(date)
     yr_fraction = decimal_year - date.year
+    seas_ds, padded_seas_ds = seasonal_cycle()
     cycle_ds = padded_seas_ds.interp({'Month_grid': yr_fraction})
 
     removed_cycle_data = data - (cycle_ds.Seasonal_SSH.values * 10)
@@ -165,7 +131,7 @@ def make_grid(ds):
     back = back.assign_coords({'longitude': back.longitude.values - 360})
     padded_ds = xr.merge([back, ds, front])
 
-    smooth_ds = smoothing(padded_ds)
+    smooth_ds = smoothing(padded_ds, min_counts)
     filtered_ds = smooth_ds.drop_vars(['counts', 'mask'])
 
     filtered_ds.SSHA.attrs = ds.SSHA.attrs
@@ -178,36 +144,97 @@ def make_grid(ds):
 
     filtered_ds.latitude.attrs = {'long_name': 'latitude', 'standard_name': 'latitude'}
     filtered_ds.longitude.attrs = {'long_name': 'longitude', 'standard_name': 'longitude'}
-    encoding = cycle_ds_encoding(filtered_ds)
 
-    filtered_ds.to_netcdf(f'{OUTPUT_DIR}/ENSO_grids/{fname}', encoding=encoding)
+    enso_path = f'{OUTPUT_DIR}/ENSO_grids/{fname}'
+    return filtered_ds, enso_path
     
 def check_update(cycle_filename):
     '''
     Check if ENSO grid needs to be generated
     '''
     date = cycle_filename.split('_')[-1].split('.')[0]
-    enso_filename = f'ssha_enso_{date}.nc'
-
-    if not os.path.exists(f'{OUTPUT_DIR}/ENSO_grids/{enso_filename}'):
-        return True
+    enso_path = f'{OUTPUT_DIR}/ENSO_grids/ssha_enso_{date}.nc'
+    cycle_path = f'{OUTPUT_DIR}/gridded_cycles/{cycle_filename}'
 
-    cycle_mod_time = datetime.fromtimestamp(os.path.getmtime(f'{OUTPUT_DIR}/gridded_cycles/{cycle_filename}'))
-    enso_mod_time = datetime.fromtimestamp(os.path.getmtime(f'{OUTPUT_DIR}/ENSO_grids/{enso_filename}'))
+    def mtime_check():
+        cycle_mod_time = datetime.fromtimestamp(os.path.getmtime(cycle_path))
+        enso_mod_time = datetime.fromtimestamp(os.path.getmtime(enso_path))
+        return cycle_mod_time > enso_mod_time
 
-    if cycle_mod_time > enso_mod_time:
-        return True
-    return False
+    return is_stale(enso_path, stat_inputs([cycle_path], OUTPUT_DIR), ENSO_PARAMS,
+                    legacy_check=mtime_check)
     
-def enso_gridding():
+def enso_cycle(cycle_path):
+    '''
+    Makes and saves the ENSO grid of a single gridded cycle. Runs in pool
+    workers when making grids in parallel, so everything it takes must be
+    picklable.
+    '''
+    print(f'Making ENSO grid for {os.path.basename(cycle_path)}')
+    with load_gridded_cycle(cycle_path) as ds:
+        enso_ds, enso_path = make_grid(ds)
+    write_netcdf(enso_ds, enso_path)
+    write_manifest(enso_path, stat_inputs([cycle_path], OUTPUT_DIR), ENSO_PARAMS)
+
+
+def enso_gridding(workers=ENSO_WORKERS):
+    '''
+    Makes the ENSO grids of new and updated gridded cycles.
+
+    Cycles are independent, so with workers > 1 they are handed to a process
+    pool. Otherwise grids are made in this process and saved in the
+    background while the next one is made.
+    '''
     os.makedirs(f'{OUTPUT_DIR}/ENSO_grids/', exist_ok=True)
     os.chmod(f'{OUTPUT_DIR}/ENSO_grids/', 0o777)
     
     simple_grid_paths = glob(f'{OUTPUT_DIR}/gridded_cycles/*.nc')
     simple_grid_paths.sort()
-    for f in simple_grid_paths:
-        filename = f.split('/')[-1]
-        if check_update(filename):
+
+    jobs = [f for f in simple_grid_paths if check_update(f.split('/')[-1])]
+    logging.info(f'{len(jobs)} ENSO grids to make')
+
+    failed = []
+    if workers > 1 and len(jobs) > 1:
+        # Load the reference grids before forking so workers inherit them
+        seasonal_cycle()
+        hr_mask()
+        logging.info(f'Making {len(jobs)} ENSO grids across {workers} workers')
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(enso_cycle, f): f.split('/')[-1] for f in jobs}
+            for future in as_completed(futures):
+                filename = futures[future]
+                e = future.exception()
+                if e is None:
+                    logging.info(f'ENSO grid for {filename} complete')
+                else:
+                    failed.append(filename)
+                    logging.error(f'Making ENSO grid for {filename} failed: {e}', exc_info=e)
+    else:
+        # ENSO grids are saved in the background while the next one is made
+        writes = deque()
+        for f in jobs:
+            filename = f.split('/')[-1]
             print(f'Making ENSO grid for {filename}')
-            ds = xr.open_dataset(f)
-            make_grid(ds)
+            try:
+                ds = load_gridded_cycle(f)
+                enso_ds, enso_path = make_grid(ds)
+                writes.append((filename, submit_write(enso_ds, enso_path,
+                                                      after=partial(write_manifest, enso_path,
+                                                                    stat_inputs([f], OUTPUT_DIR), ENSO_PARAMS))))
+            except Exception as e:
+                failed.append(filename)
+                logging.exception(f'Making ENSO grid for {filename} failed: {e}')
+
+            for written, e in finished_writes(writes, OUTPUT_PENDING_WRITES):
+                if e:
+                    failed.append(written)
+                    logging.error(f'Saving ENSO grid for {written} failed: {e}')
+
+        for written, e in finished_writes(writes):
+            if e:
+                failed.append(written)
+                logging.error(f'Saving ENSO grid for {written} failed: {e}')
+
+    if failed:
+        raise RuntimeError(f'{len(failed)} ENSO grids failed. Check logs')
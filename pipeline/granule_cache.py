@@ -0,0 +1,171 @@
+'''
+Local cache of decoded along track granules.
+
+Cycle windows overlap, so most granules are read by two cycles. The first
+read decodes the granule's time, lat, lon and SSHA from HDF5 into a single
+structured NumPy array saved under GRANULE_CACHE_DIR; later reads memory-map
+that file instead. Entries are keyed by granule path, size and mtime, so a
+redelivered granule is decoded again. The cache is kept under
+GRANULE_CACHE_MAX_BYTES by evicting the least recently used entries. Each
+process keeps a running total of the cache's size from its last scan of the
+cache directory plus the entries it has added since, and only scans again
+once that total exceeds the budget. Eviction then frees a tenth of the
+budget, so a full cache is scanned once per tenth of the budget decoded
+rather than for every granule.
+
+Values are cached as delivered, before any additive corrections, so that
+revising a correction table does not invalidate the cache.
+'''
+import hashlib
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import xarray as xr
+
+from conf.global_settings import GRANULE_CACHE_DIR, GRANULE_CACHE_MAX_BYTES
+
+GRANULE_DTYPE = np.dtype([('time', 'M8[ns]'), ('lat', 'f8'), ('lon', 'f8'), ('ssha', 'f8')])
+
+# The HDF5 library isn't thread safe and xarray's locks don't cover opening
+# files, so threads reading granules take turns decoding
+HDF5_LOCK = threading.Lock()
+
+# One lock per granule so that when threads prefetching overlapping cycles
+# both miss the cache, only the first decodes it. Entries are (lock, number
+# of threads using it) and are removed once no thread uses them.
+_granule_locks = {}
+_granule_locks_lock = threading.Lock()
+
+# Cache size as of this process's last scan plus its entries added since.
+# None until the first scan.
+_cache_bytes = None
+_cache_bytes_lock = threading.Lock()
+
+# Fraction of the budget the cache is evicted down to
+EVICT_TO = 0.9
+
+
+def decode_granule(granule):
+    '''
+    Reads the four variables gridding needs from a granule's data group
+    '''
+    with HDF5_LOCK, xr.open_dataset(granule, group='data') as ds:
+        arr = np.empty(ds.time.size, GRANULE_DTYPE)
+        arr['time'] = ds.time.values
+        arr['lat'] = ds.lats.values
+        arr['lon'] = ds.lons.values
+        arr['ssha'] = ds.ssh.values
+    return arr
+
+
+def cache_path(granule, size, mtime):
+    key = hashlib.sha1(f'{granule}:{size}:{mtime}'.encode()).hexdigest()
+    return f'{GRANULE_CACHE_DIR}/{key}.npy'
+
+
+def evict(max_bytes=GRANULE_CACHE_MAX_BYTES):
+    '''
+    Removes least recently used entries until the cache fits in max_bytes.
+    Entry mtimes are bumped on every hit, so they order entries by last use.
+
+    Returns:
+        total (int): bytes left in the cache
+    '''
+    entries = []
+    for entry in os.scandir(GRANULE_CACHE_DIR):
+        if entry.name.endswith('.npy'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    if total <= max_bytes:
+        return total
+
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    return total
+
+
+def added_entry(size, max_bytes=GRANULE_CACHE_MAX_BYTES):
+    '''
+    Adds a new entry to the running total. Once it exceeds max_bytes the
+    cache is scanned and evicted down to EVICT_TO of max_bytes.
+    '''
+    global _cache_bytes
+    with _cache_bytes_lock:
+        if _cache_bytes is not None:
+            _cache_bytes += size
+        if _cache_bytes is None or _cache_bytes > max_bytes:
+            _cache_bytes = evict(int(max_bytes * EVICT_TO))
+
+
+@contextmanager
+def granule_lock(granule):
+    with _granule_locks_lock:
+        lock, users = _granule_locks.get(granule, (None, 0))
+        lock = lock or threading.Lock()
+        _granule_locks[granule] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _granule_locks_lock:
+            lock, users = _granule_locks[granule]
+            if users == 1:
+                del _granule_locks[granule]
+            else:
+                _granule_locks[granule] = (lock, users - 1)
+
+
+def read_granule(granule):
+    '''
+    Returns the granule's decoded arrays, from the cache when possible.
+
+    Returns:
+        arr (ndarray): GRANULE_DTYPE structured array, read-only when memory-mapped
+    '''
+    with granule_lock(granule):
+        if GRANULE_CACHE_MAX_BYTES <= 0:
+            return decode_granule(granule)
+
+        stat = os.stat(granule)
+        path = cache_path(granule, stat.st_size, stat.st_mtime)
+
+        try:
+            arr = np.load(path, mmap_mode='r')
+            os.utime(path)
+            return arr
+        except (FileNotFoundError, ValueError):
+            pass
+
+        arr = decode_granule(granule)
+
+        # Write to a process and thread specific temp file so parallel workers
+        # never see a partially written entry
+        os.makedirs(GRANULE_CACHE_DIR, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, arr)
+                size = f.tell()
+            os.replace(tmp_path, path)
+            added_entry(size)
+        except OSError as e:
+            logging.warning(f'Unable to cache {granule}: {e}')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    return arr
@@ -0,0 +1,147 @@
+'''
+Persistent catalog of the along track granules found in DATA_DIR.
+
+The catalog is a small SQLite database that records the path, mission, date,
+size and modification time of every granule. It is refreshed incrementally
+once per run and answers date range queries through an index, so cycle
+gridding no longer has to glob the archive for every cycle.
+
+Every refresh also records the cycles affected by added, modified or removed
+granules as stale. They stay stale until they are successfully regridded.
+'''
+import logging
+import os
+import sqlite3
+
+import numpy as np
+
+from conf.global_settings import DATA_DIR, FILE_FORMAT, OUTPUT_DIR
+from cycle_index import cycles_for_dates
+
+CATALOG_PATH = f'{OUTPUT_DIR}/granule_catalog.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS granules (
+    path TEXT PRIMARY KEY,
+    mission TEXT NOT NULL,
+    date TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS granules_date ON granules (date);
+CREATE TABLE IF NOT EXISTS stale_cycles (
+    date TEXT PRIMARY KEY
+);
+'''
+
+
+def granule_date(path):
+    '''
+    Parses the YYYY-MM-DD date from the last 8 characters of a granule filename
+    '''
+    date = path.split('/')[-1].split('.')[0][-8:]
+    date = f'{date[:4]}-{date[4:6]}-{date[6:]}'
+    return str(np.datetime64(date))
+
+
+def granule_mission(path):
+    return path.split('/')[-2]
+
+
+def connect(catalog_path=CATALOG_PATH):
+    '''
+    Opens the catalog database, creating it if needed
+    '''
+    os.makedirs(os.path.dirname(catalog_path), exist_ok=True)
+    conn = sqlite3.connect(catalog_path)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def scan_archive():
+    '''
+    Stats every granule in DATA_DIR/<mission>/
+
+    Returns:
+        found (dict): path -> (size, mtime)
+    '''
+    found = {}
+    for mission_dir in os.scandir(DATA_DIR):
+        if not mission_dir.is_dir():
+            continue
+        for entry in os.scandir(mission_dir.path):
+            if not entry.name.endswith(FILE_FORMAT) or not entry.is_file():
+                continue
+            stat = entry.stat()
+            found[f'{DATA_DIR}/{mission_dir.name}/{entry.name}'] = (stat.st_size, stat.st_mtime)
+    return found
+
+
+def refresh(conn):
+    '''
+    Brings the catalog in line with the archive. Only granules that are new,
+    have a different size or mtime, or have disappeared are touched, and the
+    cycles they fall into are marked stale.
+
+    Returns:
+        changed (list): paths of granules added, modified or removed
+    '''
+    found = scan_archive()
+    known = {row['path']: (row['size'], row['mtime'])
+             for row in conn.execute('SELECT path, size, mtime FROM granules')}
+
+    upserts = []
+    for path, (size, mtime) in found.items():
+        if known.get(path) == (size, mtime):
+            continue
+        try:
+            date = granule_date(path)
+        except ValueError:
+            logging.warning(f'Unable to parse date from granule {path}. Skipping.')
+            continue
+        upserts.append((path, granule_mission(path), date, size, mtime))
+
+    removed = [path for path in known if path not in found]
+
+    changed_dates = [row[2] for row in upserts] + [granule_date(path) for path in removed]
+    affected = cycles_for_dates(changed_dates)
+
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO granules (path, mission, date, size, mtime) '
+                         'VALUES (?, ?, ?, ?, ?)', upserts)
+        conn.executemany('DELETE FROM granules WHERE path = ?', [(path,) for path in removed])
+        conn.executemany('INSERT OR IGNORE INTO stale_cycles (date) VALUES (?)',
+                         [(str(date),) for date in affected])
+
+    logging.info(f'Granule catalog refreshed: {len(upserts)} new or modified, {len(removed)} removed, '
+                 f'{len(affected)} cycles affected')
+    return [row[0] for row in upserts] + removed
+
+
+def granules_in_range(conn, start, end):
+    '''
+    Returns catalog rows, as dicts, for granules dated within [start, end], inclusive
+    '''
+    rows = conn.execute('SELECT path, mission, date, size, mtime FROM granules '
+                        'WHERE date BETWEEN ? AND ? ORDER BY path',
+                        (str(start), str(end)))
+    return [dict(row) for row in rows]
+
+
+def catalogued_cycles(conn):
+    '''
+    Returns every cycle date that has at least one catalogued granule
+    '''
+    dates = [row['date'] for row in conn.execute('SELECT DISTINCT date FROM granules')]
+    return cycles_for_dates(dates)
+
+
+def stale_cycles(conn):
+    return np.array([row['date'] for row in conn.execute('SELECT date FROM stale_cycles')],
+                    dtype='datetime64[D]')
+
+
+def clear_stale(conn, date):
+    with conn:
+        conn.execute('DELETE FROM stale_cycles WHERE date = ?', (str(date),))
@@ -0,0 +1,163 @@
+'''
+Storage formats for gridded cycles.
+
+The full format stores 360x720 SSHA, counts and mask planes in every file.
+The compact format stores SSHA and counts only for the grid's wet cells, along
+a single `cell` dimension, and refers to the shared mask file for where those
+cells sit. The mask file's path, wet cell count and a checksum of the wet cell
+indices are recorded in each compact file, so a compact file is never
+expanded onto a different grid.
+
+Both formats use the same file names. Readers use load_gridded_cycle, which
+returns the full Dataset whichever format the file is in, so archives can mix
+formats.
+'''
+import hashlib
+from functools import lru_cache
+
+import numpy as np
+import xarray as xr
+
+from granule_cache import HDF5_LOCK
+
+GRID_MASK_PATH = 'ref_files/UPDATED_GRID_MASK_latlon.nc'
+GRIDDED_CYCLE_FORMATS = ['full', 'compact']
+
+COMPACT_FORMAT = 'wet_cells'
+COMPACT_ATTRS = ['grid_format', 'grid_reference', 'grid_wet_cells', 'grid_checksum']
+
+# Neighbours used for cycles gridded before profiles were recorded
+LEGACY_NEIGHBOURS = 500
+
+
+def check_grid_format(grid_format):
+    if grid_format not in GRIDDED_CYCLE_FORMATS:
+        raise ValueError(f'Unknown gridded cycle format "{grid_format}". Options are {", ".join(GRIDDED_CYCLE_FORMATS)}')
+
+
+@lru_cache()
+def load_grid_reference(mask_path=GRID_MASK_PATH):
+    '''
+    Reads the 0.5 degree grid and its wet/dry mask once per process. The
+    arrays are shared, so they are made read-only. The first read can happen
+    while prefetching threads decode granules, so it takes the HDF5 lock.
+
+    Returns:
+        grid (dict): 1D lon/lat, the wet/dry mask, 2D shape, flat indices of
+                     wet cells and their checksum
+    '''
+    with HDF5_LOCK, xr.open_dataset(mask_path) as global_ds:
+        mask_c = global_ds.maskC.isel(Z=0).values
+        global_lon = global_ds.longitude.values
+        global_lat = global_ds.latitude.values
+
+    wet_ins = np.where(mask_c.ravel() > 0)[0]
+
+    grid = {
+        'path': mask_path,
+        'lon': global_lon,
+        'lat': global_lat,
+        'mask': np.where(mask_c == True, 1, 0),
+        'shape': mask_c.shape,
+        'wet': wet_ins,
+        'checksum': hashlib.sha1(wet_ins.astype('<i8').tobytes()).hexdigest()
+    }
+    for arr in grid.values():
+        if isinstance(arr, np.ndarray):
+            arr.setflags(write=False)
+    return grid
+
+
+def compact_cycle(gridded_ds, grid=None):
+    '''
+    Converts a full gridded cycle to the compact format
+
+    Params:
+        gridded_ds (Dataset): full format gridded cycle
+        grid (dict): the grid reference the cycle was gridded on
+
+    Returns:
+        compact_ds (Dataset): SSHA and counts of the wet cells
+    '''
+    grid = grid or load_grid_reference()
+    wet = grid['wet']
+
+    compact_ds = xr.Dataset(
+        data_vars={var: (['cell'], gridded_ds[var].values.ravel()[wet], gridded_ds[var].attrs)
+                   for var in ['SSHA', 'counts']},
+        coords={coord: gridded_ds[coord] for coord in ['time', 'latitude', 'longitude']},
+        attrs=gridded_ds.attrs
+    )
+    compact_ds.attrs.update({
+        'grid_format': COMPACT_FORMAT,
+        'grid_reference': grid['path'],
+        'grid_wet_cells': len(wet),
+        'grid_checksum': grid['checksum']
+    })
+    return compact_ds
+
+
+def expand_cycle(compact_ds):
+    '''
+    Rebuilds the full gridded cycle from a compact one, using the grid
+    reference it was written with
+
+    Returns:
+        gridded_ds (Dataset): full format gridded cycle
+    '''
+    grid = load_grid_reference(compact_ds.attrs['grid_reference'])
+    if compact_ds.attrs['grid_checksum'] != grid['checksum']:
+        raise ValueError(f'Compact cycle was written on a different grid than {grid["path"]}')
+
+    data_vars = {}
+    for var in ['SSHA', 'counts']:
+        plane = np.full(grid['shape'], np.nan, compact_ds[var].dtype)
+        plane.ravel()[grid['wet']] = compact_ds[var].values
+        data_vars[var] = (['latitude', 'longitude'], plane, compact_ds[var].attrs)
+
+    # Full files store the mask with the data variables' encoding
+    data_vars['mask'] = (['latitude', 'longitude'], grid['mask'].astype(compact_ds['SSHA'].dtype),
+                         {'long_name': 'wet/dry boolean mask for grid cell',
+                          'comment': '1 for ocean, otherwise 0'})
+
+    attrs = {k: v for k, v in compact_ds.attrs.items() if k not in COMPACT_ATTRS}
+    return xr.Dataset(data_vars=data_vars,
+                      coords={coord: compact_ds[coord] for coord in ['time', 'latitude', 'longitude']},
+                      attrs=attrs)
+
+
+def load_gridded_cycle(path):
+    '''
+    Reads a gridded cycle in either format. Stages save their products with
+    a background writer while reading the next cycle, so the file is read in
+    full under the HDF5 lock rather than lazily.
+
+    Returns:
+        gridded_ds (Dataset): full format gridded cycle, in memory
+    '''
+    with HDF5_LOCK, xr.open_dataset(path) as ds:
+        ds.load()
+
+    if ds.attrs.get('grid_format') != COMPACT_FORMAT:
+        return ds
+    return expand_cycle(ds)
+
+
+def gridding_neighbours(gridded_ds):
+    '''
+    Number of neighbours a cycle was gridded with, the most along track points
+    any of its cells can count. Cycles gridded before it was recorded use
+    their profile's, or the production profile's if that isn't recorded either.
+    '''
+    if 'gridding_neighbours' in gridded_ds.attrs:
+        return int(gridded_ds.attrs['gridding_neighbours'])
+    if 'gridding_profile' in gridded_ds.attrs:
+        from gridding_engines import get_gridding_profile
+        return get_gridding_profile(gridded_ds.attrs['gridding_profile'])['neighbours']
+    return LEGACY_NEIGHBOURS
+
+
+def gridded_cycle_date(path):
+    date = path.split('_')[-1][:8]
+    return np.datetime64(f'{date[:4]}-{date[4:6]}-{date[6:8]}')
+
@@ -0,0 +1,125 @@
+'''
+Benchmarks the gridding profiles in conf/gridding_profiles.yaml against the
+production profile on a sample of catalogued cycles.
+
+For each profile it reports the mean wall time per cycle, the peak memory
+used while gridding and the RMS SSHA difference from the production profile
+over cells both profiles filled.
+
+Every profile grids the first cycle once untimed, so one-time costs (the
+target grid, reused planes, imports) aren't charged to whichever profile runs
+first. Time and memory are measured in separate runs. Memory is the growth of
+the peak resident set of a fresh worker process, so it includes what the
+engines' C extensions (pykdtree, OpenMP) allocate, which tracemalloc misses.
+'''
+import logging
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from conf.global_settings import GRIDDING_THREADS
+from cycle_gridding import collect_data, gridding, merge_granules
+from cycle_index import cycle_window
+from granule_catalog import catalogued_cycles, connect, refresh
+from gridding_engines import get_gridding_profile, load_gridding_profiles
+
+REFERENCE_PROFILE = 'production'
+
+
+def sample_cycles(catalog, n_cycles):
+    '''
+    Picks n_cycles evenly spaced through the catalogued record
+    '''
+    cycle_dates = catalogued_cycles(catalog)
+    if len(cycle_dates) <= n_cycles:
+        return cycle_dates
+    return cycle_dates[np.linspace(0, len(cycle_dates) - 1, n_cycles).astype(int)]
+
+
+def time_profile(cycle_ds, date, sources, params, nprocs):
+    start = time.perf_counter()
+    gridded_ds = gridding(cycle_ds, date, sources, params, nprocs)
+    seconds = time.perf_counter() - start
+
+    # gridding reuses its output planes, keep a copy
+    return gridded_ds['SSHA'].values.copy(), seconds
+
+
+def peak_growth(cycle_ds, date, sources, params, nprocs):
+    '''
+    Grids the cycle and returns how much this process's peak resident set
+    grew, in bytes. ru_maxrss is in KiB on Linux.
+    '''
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    gridding(cycle_ds, date, sources, params, nprocs)
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start) * 1024
+
+
+def memory_profile(cycle_ds, date, sources, params, nprocs):
+    '''
+    Peak memory used gridding the cycle, measured in a fresh worker process.
+    The worker is forked after the warm up, so it inherits the target grid.
+    '''
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(peak_growth, cycle_ds, date, sources, params, nprocs).result()
+
+
+def benchmark_profiles(n_cycles=4, nprocs=GRIDDING_THREADS):
+    '''
+    Grids a sample of cycles under every profile and logs a comparison table.
+
+    Returns:
+        results (dict): profile name -> mean seconds, peak MB and RMS difference in m
+    '''
+    catalog = connect()
+    refresh(catalog)
+    cycle_dates = sample_cycles(catalog, n_cycles)
+
+    profile_names = [REFERENCE_PROFILE] + [p for p in load_gridding_profiles() if p != REFERENCE_PROFILE]
+    stats = {name: {'seconds': [], 'peak': [], 'sq_diff': [], 'n': 0} for name in profile_names}
+    warmed_up = set()
+
+    for date in cycle_dates:
+        cycle_granules = collect_data(catalog, *cycle_window(date))
+        if not cycle_granules:
+            continue
+
+        logging.info(f'Benchmarking gridding profiles on {date} cycle')
+        cycle_ds = merge_granules([g['path'] for g in cycle_granules])
+        sources = list(set([g['mission'] for g in cycle_granules]))
+
+        reference = None
+        for name in profile_names:
+            params = get_gridding_profile(name)
+            if name not in warmed_up:
+                gridding(cycle_ds, date, sources, params, nprocs)
+                warmed_up.add(name)
+
+            ssha, seconds = time_profile(cycle_ds, date, sources, params, nprocs)
+            stats[name]['seconds'].append(seconds)
+            stats[name]['peak'].append(memory_profile(cycle_ds, date, sources, params, nprocs))
+
+            if reference is None:
+                reference = ssha
+            both = ~np.isnan(reference) & ~np.isnan(ssha)
+            stats[name]['sq_diff'].append(np.sum((ssha[both] - reference[both]) ** 2))
+            stats[name]['n'] += np.sum(both)
+
+    catalog.close()
+
+    results = {}
+    logging.info(f'Gridding benchmark over {len(cycle_dates)} cycles, rms relative to {REFERENCE_PROFILE}')
+    logging.info(f'{"profile":<20} {"seconds":>10} {"peak MB":>10} {"rms (m)":>12}')
+    for name in profile_names:
+        if not stats[name]['seconds']:
+            continue
+        results[name] = {
+            'seconds': float(np.mean(stats[name]['seconds'])),
+            'peak_mb': max(stats[name]['peak']) / 2**20,
+            'rms': float(np.sqrt(np.sum(stats[name]['sq_diff']) / max(stats[name]['n'], 1)))
+        }
+        logging.info(f'{name:<20} {results[name]["seconds"]:>10.2f} '
+                     f'{results[name]["peak_mb"]:>10.1f} {results[name]["rms"]:>12.3e}')
+    return results
@@ -0,0 +1,142 @@
+'''
+Gaussian weighted gridding engines used by cycle_gridding.
+
+Every engine takes the along track lon/lat/ssha vectors of a cycle and the
+target grid from cycle_gridding.load_target_grid, and returns the gridded
+value and the number of contributing points for every wet target cell. They
+share pyresample's semantics: each target cell uses up to `neighbours` nearest
+points within `roi` meters, weighted by exp(-d^2 / sigma^2), with distances
+measured as chords on pyresample's sphere.
+
+Named parameter profiles (engine, roi, sigma, neighbours) are defined in
+conf/gridding_profiles.yaml.
+
+pyresample is the reference engine. The kdtree engine skips the uncertainty
+estimate and pyresample's per-call bookkeeping. pyresample builds the target
+cartesian coordinates in the float32 precision of the grid file, so distances
+differ from the kdtree engine's by up to ~1.5 m. With the production
+neighbours (500) SSHA agrees to within 1e-5 m (typically 1e-7 m), and counts
+may differ by 1 for points lying within that margin of roi. With very few
+neighbours a near tie at the neighbour cutoff can swap a point and move a
+cell by a few mm.
+'''
+import warnings
+from functools import lru_cache
+
+import numpy as np
+import yaml
+from scipy.spatial import cKDTree
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', UserWarning)
+    import pyresample as pr
+    from pyresample.kd_tree import resample_gauss
+    from pyresample.utils import check_and_wrap
+
+# Sphere radius (m) pyresample uses for its cartesian coordinates
+EARTH_RADIUS = 6370997.0
+
+# Number of target cells queried at once by the kdtree engine. Bounds memory
+# to roughly batch size * neighbours * 32 bytes.
+KDTREE_BATCH_SIZE = 4096
+
+
+def lonlat_to_cartesian(lons, lats):
+    '''
+    Cartesian coordinates on the sphere pyresample uses for its kd-trees
+    '''
+    lons = np.deg2rad(np.asarray(lons, dtype=np.float64))
+    lats = np.deg2rad(np.asarray(lats, dtype=np.float64))
+    xyz = np.empty((lons.size, 3))
+    xyz[:, 0] = EARTH_RADIUS * np.cos(lats) * np.cos(lons)
+    xyz[:, 1] = EARTH_RADIUS * np.cos(lats) * np.sin(lons)
+    xyz[:, 2] = EARTH_RADIUS * np.sin(lats)
+    return xyz
+
+
+def pyresample_gauss(lons, lats, ssha, target, params, nprocs=1):
+    tmp_ssha_lons, tmp_ssha_lats = check_and_wrap(lons, lats)
+
+    ssha_grid = pr.geometry.SwathDefinition(lons=tmp_ssha_lons, lats=tmp_ssha_lats)
+    new_vals, _, counts = resample_gauss(ssha_grid, ssha,
+                                         target['swath'], params['roi'],
+                                         params['sigma'], params['neighbours'],
+                                         fill_value=np.nan, nprocs=nprocs, with_uncert=True)
+    return new_vals, counts
+
+
+def kdtree_gauss(lons, lats, ssha, target, params, nprocs=1, batch_size=KDTREE_BATCH_SIZE):
+    tree = cKDTree(lonlat_to_cartesian(lons, lats))
+
+    # Missing neighbours are reported with index tree.n, point those at a
+    # zero so they can be gathered without masking
+    values = np.append(ssha, 0)
+
+    target_xyz = target['xyz']
+    new_vals = np.empty(len(target_xyz))
+    counts = np.empty(len(target_xyz))
+
+    for start in range(0, len(target_xyz), batch_size):
+        stop = start + batch_size
+        dist, idx = tree.query(target_xyz[start:stop], k=params['neighbours'],
+                               distance_upper_bound=params['roi'], workers=nprocs)
+        if params['neighbours'] == 1:
+            dist, idx = dist[:, np.newaxis], idx[:, np.newaxis]
+
+        # Missing neighbours have infinite distance and so zero weight
+        weights = np.exp(-dist ** 2 / params['sigma'] ** 2)
+        weight_sums = weights.sum(axis=1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            new_vals[start:stop] = np.einsum('ij,ij->i', weights, values[idx]) / weight_sums
+        new_vals[start:stop][weight_sums == 0] = np.nan
+        counts[start:stop] = np.count_nonzero(idx < tree.n, axis=1)
+
+    return new_vals, counts
+
+
+ENGINES = {
+    'pyresample': {
+        'function': pyresample_gauss,
+        'description': 'pyresample resample_gauss'
+    },
+    'kdtree': {
+        'function': kdtree_gauss,
+        'description': 'scipy cKDTree gaussian weighting'
+    }
+}
+
+
+def get_engine(name):
+    if name not in ENGINES:
+        raise ValueError(f'Unknown gridding engine "{name}". Options are {", ".join(ENGINES)}')
+    return ENGINES[name]
+
+
+@lru_cache()
+def load_gridding_profiles(config_path='conf/gridding_profiles.yaml'):
+    '''
+    Returns:
+        profiles (dict): profile name -> gridding params
+    '''
+    with open(config_path, "r") as stream:
+        config = yaml.load(stream, yaml.Loader)
+
+    profiles = {}
+    for c in config:
+        get_engine(c['engine'])
+        profiles[c['name']] = {
+            'profile': c['name'],
+            'engine': c['engine'],
+            'roi': float(c['roi']),
+            'sigma': float(c['sigma']),
+            'neighbours': int(c['neighbours'])
+        }
+    return profiles
+
+
+def get_gridding_profile(name):
+    profiles = load_gridding_profiles()
+    if name not in profiles:
+        raise ValueError(f'Unknown gridding profile "{name}". Options are {", ".join(profiles)}')
+    return dict(profiles[name])
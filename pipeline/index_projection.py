@@ -0,0 +1,69 @@
+'''
+Batched least squares projection of SSHA anomalies onto climate patterns.
+
+A cycle's index is the least squares fit of its anomaly onto the pattern over
+the cells where both are valid. The pattern is fixed and the valid cells are
+usually the same from cycle to cycle, so the projector (the pseudo-inverse of
+the pattern restricted to the valid cells) is computed once per distinct mask
+and cached. Cycles sharing a mask are stacked into a matrix and projected with
+a single matmul; a cycle with a mask of its own is projected on its own.
+'''
+import numpy as np
+
+# Projectors kept per pattern. Each holds one float64 per valid cell.
+PROJECTOR_CACHE_SIZE = 32
+
+
+def pattern_projector(pattern_field, mask, cache=None):
+    '''
+    Least squares projector for the pattern restricted to mask. pinv solves
+    the fit through the SVD, as lstsq does, instead of inverting XᵀX.
+
+    Params:
+        pattern_field (ndarray): flattened pattern values
+        mask (ndarray): flattened boolean mask of the cells fitted
+        cache (dict): packed mask -> projector, reused between calls
+
+    Returns:
+        projector (ndarray): (n cells in mask,) weights giving the index as a dot product
+    '''
+    # pinv of an empty matrix would silently give an index of 0
+    if not mask.any():
+        raise ValueError('No valid cells to fit the pattern to')
+
+    key = np.packbits(mask).tobytes()
+    if cache is not None and key in cache:
+        return cache[key]
+
+    X = pattern_field[mask][:, np.newaxis].astype(np.float64)
+    projector = np.linalg.pinv(X)[0]
+
+    if cache is not None:
+        if len(cache) >= PROJECTOR_CACHE_SIZE:
+            cache.pop(next(iter(cache)))
+        cache[key] = projector
+    return projector
+
+
+def project_indices(pattern_field, anoms, cache=None):
+    '''
+    Fits every cycle's anomaly onto the pattern
+
+    Params:
+        pattern_field (ndarray): flattened pattern values
+        anoms (ndarray): (cycles, cells) flattened anomalies, NaN where not fitted
+        cache (dict): projector cache for this pattern, see pattern_projector
+
+    Returns:
+        indices (ndarray): (cycles,) index of each cycle
+    '''
+    nonnans = ~np.isnan(anoms)
+    masks, members = np.unique(nonnans, axis=0, return_inverse=True)
+    members = members.ravel()
+
+    indices = np.empty(len(anoms))
+    for i, mask in enumerate(masks):
+        rows = np.flatnonzero(members == i)
+        projector = pattern_projector(pattern_field, mask, cache)
+        indices[rows] = anoms[rows][:, mask] @ projector
+    return indices
@@ -0,0 +1,142 @@
+'''
+Time series stores for the indicator products.
+
+Each product (indicators, globals and every pattern's anomalies) is kept in a
+cycle_store with one time slot per cycle, so recalculating a cycle overwrites
+its slot instead of rewriting the product. The indicators store also records
+the checksum of the gridded cycle each slot was calculated from, which is how
+indicators() finds the cycles needing calculation. Gridded cycles that are
+touched, copied or restored keep their checksum, so they aren't recalculated.
+The checksum is the one the indicators manifest keeps (see manifest), stored
+as its first 64 bits so it fits a numeric slot.
+
+indicators.nc, globals.nc and <pattern>_anoms.nc are exported from the stores.
+'''
+import os
+
+import netCDF4
+import numpy as np
+import xarray as xr
+
+from conf.global_settings import INDICATOR_STORE_CHUNKS, OUTPUT_DIR
+from cycle_store import clear_slot, create_store, open_store, slot_values, write_slot
+from granule_cache import HDF5_LOCK
+from output_writer import FLOAT32_COORDS, write_netcdf_blocks
+
+INDICATOR_STORE_DIR = f'{OUTPUT_DIR}/indicator/store'
+
+# The product whose store records each slot's source checksum
+INDEX_PRODUCT = 'indicators'
+SOURCE_VAR = 'source_checksum'
+
+
+def product_names(patterns):
+    return [INDEX_PRODUCT, 'globals'] + [f'{pattern}_anoms' for pattern in patterns]
+
+
+def store_path(product):
+    return f'{INDICATOR_STORE_DIR}/{product}.nc'
+
+
+def source_id(checksum):
+    '''
+    The first 64 bits of a gridded cycle's hex checksum, as recorded in its slot
+    '''
+    return int.from_bytes(bytes.fromhex(checksum[:16]), 'big', signed=True)
+
+
+def stores_exist(products):
+    '''
+    Checks every product's store exists and records source checksums. Stores
+    made before checksums were recorded have to be rebuilt.
+    '''
+    if not all(os.path.exists(store_path(product)) for product in products):
+        return False
+
+    with HDF5_LOCK, netCDF4.Dataset(store_path(INDEX_PRODUCT), 'r') as nc:
+        return SOURCE_VAR in nc.variables
+
+
+def create_product_store(product, cycle_ds, chunks=INDICATOR_STORE_CHUNKS):
+    '''
+    Creates a product's store using one cycle of the product as the template.
+    Variables are stored as float32, as in the exported products. Scalar
+    coordinates (ie: Z) are written once and stay coordinates when opened.
+
+    Params:
+        product (str): the product's name
+        cycle_ds (Dataset): one cycle of the product, with a time dimension of length 1
+    '''
+    cycle_ds = cycle_ds.isel(time=0, drop=True)
+    scalar_coords = [coord for coord in cycle_ds.coords if coord not in cycle_ds.dims]
+
+    template = cycle_ds.drop_vars(scalar_coords)
+    template = template.assign_coords({dim: template[dim].astype('float32') for dim in template.dims})
+    for var in template.data_vars:
+        attrs = dict(template[var].attrs)
+        if scalar_coords:
+            attrs['coordinates'] = ' '.join(scalar_coords)
+        template[var] = template[var].astype('float32').assign_attrs(attrs)
+
+    if product == INDEX_PRODUCT:
+        template[SOURCE_VAR] = xr.DataArray(np.int64(0), attrs={
+            'long_name': 'checksum of the gridded cycle the slot was calculated from',
+            'comment': 'first 64 bits of the SHA-256 checksum, as a signed big-endian integer'
+        })
+
+    create_store(store_path(product), template, static={coord: cycle_ds[coord] for coord in scalar_coords},
+                 chunks=chunks, attrs=cycle_ds.attrs)
+
+
+def calculated_cycles():
+    '''
+    Returns:
+        sources (dict): cycle date -> source_id of the gridded cycle its
+                        indicators were calculated from
+    '''
+    path = store_path(INDEX_PRODUCT)
+    if not os.path.exists(path):
+        return {}
+    return slot_values(path, SOURCE_VAR)
+
+
+def write_cycle(date, cycle_products, source):
+    '''
+    Writes a cycle into every product's store. The indicators store is
+    written last, so the cycle is only recorded as calculated once every
+    product holds it.
+
+    Params:
+        date (datetime64): the cycle's date
+        cycle_products (dict): product name -> the cycle's Dataset, with a time dimension of length 1
+        source (int): source_id of the gridded cycle
+    '''
+    for product in sorted(cycle_products, key=lambda product: product == INDEX_PRODUCT):
+        cycle_ds = cycle_products[product]
+        values = {var: cycle_ds[var].values[0] for var in cycle_ds.data_vars}
+        if product == INDEX_PRODUCT:
+            values[SOURCE_VAR] = source
+        write_slot(store_path(product), date, values)
+
+
+def clear_cycle(date, products):
+    '''
+    Removes a cycle from every product's store
+    '''
+    for product in products:
+        if os.path.exists(store_path(product)):
+            clear_slot(store_path(product), date)
+
+
+def export_product(product, path):
+    '''
+    Saves every cycle in a product's store to path, a block of cycles at a time
+
+    Returns:
+        stats (dict): see output_writer.write_netcdf
+    '''
+    with open_store(store_path(product)) as ds:
+        ds = ds.drop_vars(SOURCE_VAR, errors='ignore')
+        # The products have always been written without time attributes
+        ds['time'].attrs = {}
+        return write_netcdf_blocks(ds, path, coord_encoding=FLOAT32_COORDS)
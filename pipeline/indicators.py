@@ -2,436 +2,493 @@ from glob import glob
 import logging
 import os
 import warnings
+from collections import deque
 from datetime import datetime
 from shutil import copyfile
 
 import numpy as np
+import pandas as pd
 import xarray as xr
-from netCDF4 import default_fillvals # type: ignore
-from conf.global_settings import OUTPUT_DIR
+from conf.global_settings import INDICATOR_BATCH_SIZE, INDICATORS_FULL_REBUILD, OUTPUT_DIR, OUTPUT_PENDING_WRITES
+from gridded_cycles import gridded_cycle_date, gridding_neighbours, load_gridded_cycle
+from index_projection import project_indices
+from indicator_store import (INDICATOR_STORE_DIR, calculated_cycles, clear_cycle, create_product_store, export_product,
+                             product_names, source_id, store_path, stores_exist, write_cycle)
+from manifest import fingerprint, is_stale, load_manifest, save_manifest, stat_inputs
+from output_writer import finished_writes, writer_pool
 
 with warnings.catch_warnings():
     warnings.simplefilter('ignore', UserWarning)
-    import pyresample as pr
     from pyresample.utils import check_and_wrap
 
+PATTERNS = ['enso', 'pdo', 'iod']
 
 
 def validate_counts(ds, threshold=0.9):
     '''
-    Checks if counts average is above threshold value.
+    Checks if counts average is above threshold of the most a cell can count.
     '''
     counts = ds.sel(latitude=slice(-66, 66))['counts'].values
     mean = np.nanmean(counts)
 
-    if mean > threshold * 500:
+    if mean > threshold * gridding_neighbours(ds):
         return True
 
     return False
 
 
-def calc_linear_trend(cycle_ds):
-    trend_ds = xr.open_dataset('ref_files/BH_offset_and_trend_v0_new_grid.nc')
-
-    cycle_time = cycle_ds.time.values.astype('datetime64[D]')
-
-    time_diff = (cycle_time - np.datetime64('1992-10-02')).astype(np.int32) * 86400
-    trend = time_diff * trend_ds['BH_sea_level_trend_meters_per_second'] + trend_ds['BH_sea_level_offset_meters']
-
-    return trend
-
-
-def calc_spatial_mean(global_dam, ecco_latlon_grid, ct):
-    global_dam_slice = global_dam.sel(latitude=slice(-66, 66))
-    ecco_latlon_grid_slice = ecco_latlon_grid.sel(latitude=slice(-66, 66))
-
-    nzp = np.where(~np.isnan(global_dam_slice), 1, np.nan)
-    area_nzp = np.sum(nzp * ecco_latlon_grid_slice.area)
-
-    spatial_mean = float(np.nansum(global_dam_slice * ecco_latlon_grid_slice.area) / area_nzp)
-
-    spatial_mean_da = xr.DataArray(spatial_mean, coords={'time': ct}, attrs=global_dam.attrs)
-
-    spatial_mean_da.name = 'spatial_mean'
-    spatial_mean_da.attrs['comment'] = 'Global SSHA spatial mean'
-    return spatial_mean_da
-
-
-def calc_climate_index(agg_ds, pattern, pattern_ds, ann_cyc_in_pattern):
+def load_global_grids(ecco_latlon_grid):
     """
+    Reads the rasters global preprocessing needs, once per run
 
     Params:
-        agg_ds (Dataset): the aggregated cycle Dataset object
-        pattern (str): the name of the pattern
-        pattern_ds (Dataset): the actual pattern object
-        ann_cyc_in_pattern (Dict):
-        weights_dir (Path): the Path to the directory containing the stored pattern weights
+        ecco_latlon_grid (Dataset): the global grid geometry
     Returns:
-        LS_result (List[float]):
-        center_time (Datetime):
+        grids (Dict): the ocean mask, cell areas between -66 and 66 latitude
+                      and the linear trend's rate and offset
     """
+    trend_ds = xr.open_dataset('ref_files/BH_offset_and_trend_v0_new_grid.nc').load()
 
-    center_time = agg_ds.time.values
-
-    # determine its month
-    agg_ds_center_mon = int(str(center_time)[5:7])
-
-    pattern_field = pattern_ds[pattern][f'{pattern}_pattern'].values
-
-    ssha_da = agg_ds[f'SSHA_{pattern}_removed_global_linear_trend']
-
-    # remove the monthly mean pattern from the gridded ssha
-    # now ssha_anom is w.r.t. seasonal cycle and MDT
-    ssha_anom = ssha_da.values - ann_cyc_in_pattern[pattern].ann_pattern.sel(month=agg_ds_center_mon).values/1e3
-
-    # set ssha_anom to nan wherever the original pattern is nan
-    ssha_anom = np.where(~np.isnan(pattern_ds[pattern][f'{pattern}_pattern']), ssha_anom, np.nan)
-
-    # extract out all non-nan values of ssha_anom, these are going to
-    # be the points that we fit
-    nonnans = ~np.isnan(ssha_anom)
-    ssha_anom_to_fit = ssha_anom[nonnans]
+    return {
+        'mask': ecco_latlon_grid.maskC.isel(Z=0) > 0,
+        'area': ecco_latlon_grid.area.sel(latitude=slice(-66, 66)).values,
+        'trend_rate': trend_ds['BH_sea_level_trend_meters_per_second'],
+        'trend_offset': trend_ds['BH_sea_level_offset_meters']
+    }
 
-    # do the same for the pattern
-    pattern_to_fit = pattern_field[nonnans]/1e3
 
-    # just for fun extract out same points from ssha, we'll see if
-    # removing the monthly climatology makes much of a difference
-    ssha_to_fit = ssha_da.copy(deep=True)
-    ssha_to_fit = ssha_da.values[nonnans]
-
-    X = np.vstack(np.array(pattern_to_fit))
-
-    # Good old Gauss
-    B_hat = np.matmul(np.matmul(np.linalg.inv(np.matmul(X.T, X)), X.T), ssha_anom_to_fit.T)
-    offset = 0
-    index = B_hat[0]
-
-    # now minimize ssha_to_fit
-    B_hat = np.matmul(np.matmul(np.linalg.inv(np.matmul(X.T, X)), X.T), ssha_to_fit.T)
-    offset_b = 0
-    index_b = B_hat[0]
+def scalar_dtype(array_dtype, scalar):
+    """
+    The dtype NumPy gives an array combined with a single cycle's scalar, so
+    stacked cycles keep the precision each cycle was calculated with
+    """
+    return np.result_type(array_dtype, np.asarray(scalar))
 
-    LS_result = [offset, index, offset_b, index_b]
 
-    lats = ssha_da.latitude.values
-    lons = ssha_da.longitude.values
+def calc_global_fields(cycle_dss, grids):
+    """
+    Land masks a stack of cycles and removes their spatial mean and linear
+    trend, as array operations over (time, latitude, longitude)
 
-    ssha_anom = xr.DataArray(ssha_anom, dims=['latitude', 'longitude'],
-                             coords={'longitude': lons,
-                                     'latitude': lats})
+    Params:
+        cycle_dss (List[Dataset]): the gridded cycles
+        grids (Dict): see load_global_grids
+    Returns:
+        global_dsm (Dataset): the masked, mean removed, trend and detrended SSHA of every cycle
+        spatial_means (ndarray): area weighted mean between -66 and 66 latitude of every cycle
+    """
+    ssha = xr.concat([cycle_ds['SSHA'] for cycle_ds in cycle_dss], dim='time')
 
-    return LS_result, center_time, ssha_anom
+    # Area mask the cycle data. Cells of exactly 0 are masked too.
+    global_dam = ssha.where(grids['mask'])
+    global_dam = global_dam.where(global_dam)
 
+    global_dam.name = 'SSHA_GLOBAL'
+    global_dam.attrs['comment'] = 'Global SSHA land masked'
+    global_dsm = global_dam.to_dataset()
 
-def save_files(date, indicator_ds, globals_ds, pattern_and_anom_das):
-    ds_and_paths = []
+    # Spatial Mean
+    band = global_dam.sel(latitude=slice(-66, 66)).values
+    nzp = np.where(~np.isnan(band), 1, np.nan)
+    area_nzp = np.nansum(nzp * grids['area'], axis=(1, 2))
+    spatial_means = np.nansum(band * grids['area'], axis=(1, 2)) / area_nzp
 
-    fp_date = date.replace('-', '_')
-    cycle_indicators_path = f'{OUTPUT_DIR}/indicator/daily/cycle_indicators'
-    os.makedirs(cycle_indicators_path, exist_ok=True)
-    os.chmod(cycle_indicators_path, 0o777)
-    
-    indicator_output_path = f'{cycle_indicators_path}/{fp_date}_indicator.nc'
-    ds_and_paths.append((indicator_ds, indicator_output_path))
+    means = spatial_means.astype(scalar_dtype(global_dam.dtype, spatial_means[0]))
+    global_dam_removed_mean = global_dam - means[:, np.newaxis, np.newaxis]
+    global_dam_removed_mean.attrs['comment'] = 'Global SSHA with global spatial mean removed'
+    global_dsm['SSHA_GLOBAL_removed_global_spatial_mean'] = global_dam_removed_mean
 
-    cycle_globals_path = f'{OUTPUT_DIR}/indicator/daily/cycle_globals'
-    os.makedirs(cycle_globals_path, exist_ok=True)
-    os.chmod(cycle_globals_path, 0o777)
-    
-    global_output_path = f'{cycle_globals_path}/{fp_date}_globals.nc'
-    ds_and_paths.append((globals_ds, global_output_path))
-
-    for pattern in pattern_and_anom_das.keys():
-        pattern_anom_ds = pattern_and_anom_das[pattern]
-        pattern_anom_ds = pattern_anom_ds.expand_dims(time=[pattern_anom_ds.time.values])
-
-        os.makedirs(f'{OUTPUT_DIR}/indicator/daily/cycle_pattern_anoms/', exist_ok=True)
-        os.chmod(cycle_pattern_anoms_path, 0o777)
+    # Linear Trend
+    cycle_time = ssha.time.values.astype('datetime64[D]')
+    time_diff = (cycle_time - np.datetime64('1992-10-02')).astype(np.int32) * 86400
+    time_diff = time_diff.astype(scalar_dtype(grids['trend_rate'].dtype, time_diff[0]))
 
-        cycle_pattern_anoms_path = f'{OUTPUT_DIR}/indicator/daily/cycle_pattern_anoms/{pattern}'
-        os.makedirs(cycle_pattern_anoms_path, exist_ok=True)
-        os.chmod(cycle_pattern_anoms_path, 0o777)
-        
-        pattern_anoms_output_path = f'{cycle_pattern_anoms_path}/{fp_date}_{pattern}_ssha_anoms.nc'
-        ds_and_paths.append((pattern_anom_ds, pattern_anoms_output_path))
+    trend = grids['trend_rate'] * xr.DataArray(time_diff, dims=['time'], coords={'time': ssha.time})
+    trend = trend.transpose('time', ...) + grids['trend_offset']
+    global_dsm['SSHA_GLOBAL_linear_trend'] = trend
 
-    encoding_each = {'zlib': True,
-                     'complevel': 5,
-                     'dtype': 'float32',
-                     'shuffle': True,
-                     '_FillValue': default_fillvals['f8']}
+    global_dam_detrended = global_dam - trend
+    global_dam_detrended.attrs['comment'] = 'Global SSHA with linear trend removed'
+    global_dsm['SSHA_GLOBAL_removed_linear_trend'] = global_dam_detrended
 
-    for ds, path in ds_and_paths:
+    if 'Z' in global_dsm.data_vars:
+        global_dsm = global_dsm.drop_vars('Z')
 
-        coord_encoding = {}
-        for coord in ds.coords:
-            coord_encoding[coord] = {'_FillValue': None,
-                                     'dtype': 'float32',
-                                     'complevel': 6}
+    return global_dsm, spatial_means
 
-        var_encoding = {var: encoding_each for var in ds.data_vars}
 
-        encoding = {**coord_encoding, **var_encoding}
+def load_pattern_context(pattern, global_lon, global_lat, ann_ds):
+    """
+    Reads a pattern and everything the per cycle calculation needs about it,
+    once per run.
 
-        ds.to_netcdf(path, encoding=encoding)
-        ds.close()
+    Params:
+        pattern (str): the name of the pattern
+        global_lon, global_lat (ndarray): the global grid's coordinates
+        ann_ds (Dataset): the monthly global sla climatology
+    Returns:
+        context (Dict): the pattern's field, the global grid indices of its
+                        region, its nan mask and its monthly climatology in m
+    """
+    pattern_ds = xr.open_dataset(f'ref_files/{pattern}_pattern_and_index.nc')
+    pattern_field = pattern_ds[f'{pattern}_pattern'].values
+
+    # get the geographic bounds of the sla pattern
+    pattern_geo_bnds = [float(pattern_ds.Latitude[0].values),
+                        float(pattern_ds.Latitude[-1].values),
+                        float(pattern_ds.Longitude[0].values),
+                        float(pattern_ds.Longitude[-1].values)]
+
+    # extract the sla annual cycle in the region of the pattern
+    ann_cyc_in_pattern = ann_ds.sel(Latitude=slice(pattern_geo_bnds[0], pattern_geo_bnds[1]),
+                                    Longitude=slice(pattern_geo_bnds[2], pattern_geo_bnds[3]))
+    climatology = ann_cyc_in_pattern.ann_pattern.sel(month=np.arange(1, 13)).transpose('month', ...).values / 1e3
+
+    # Positions of the pattern's (wrapped) coordinates on the global grid
+    pattern_lons, pattern_lats = check_and_wrap(pattern_ds['Longitude'].values,
+                                                pattern_ds['Latitude'].values)
+    lon_idx = pd.Index(global_lon).get_indexer(pattern_lons)
+    lat_idx = pd.Index(global_lat).get_indexer(pattern_lats)
+    if (lon_idx < 0).any() or (lat_idx < 0).any():
+        raise ValueError(f'{pattern} pattern coordinates are not on the global grid')
+
+    return {
+        'field': pattern_field,
+        'mask': ~np.isnan(pattern_field),
+        'lon_idx': lon_idx,
+        'lat_idx': lat_idx,
+        'climatology': np.ascontiguousarray(climatology)
+    }
+
+
+def calc_pattern_anoms(agg_da, context):
+    """
+    Removes the pattern's monthly climatology from a stack of cycles
 
-    return
+    Params:
+        agg_da (DataArray): (time, latitude, longitude) detrended SSHA in the pattern's region
+        context (Dict): the pattern's context, see load_pattern_context
+    Returns:
+        ssha_anoms (ndarray): the anomalies, nan wherever the pattern is nan
+    """
+    # remove the monthly mean pattern from the gridded ssha
+    # now ssha_anom is w.r.t. seasonal cycle and MDT
+    months = agg_da.time.dt.month.values
+    ssha_anoms = agg_da.values - context['climatology'][months - 1]
 
+    # set ssha_anom to nan wherever the original pattern is nan
+    return np.where(context['mask'], ssha_anoms, np.nan)
 
-def concat_files(indicator_dir, type, pattern=''):
-    # Glob daily indicators
-    daily_path = f'{indicator_dir}/daily/cycle_{type}s/{pattern}'
-    daily_files = [x for x in glob(f'{daily_path}/*.nc') if os.path.isfile(x)]
-    daily_files.sort()
 
-    files = daily_files
+def calc_batch(cycle_dss, grids, pattern_contexts, pattern_fields, projectors):
+    """
+    Calculates the global fields, pattern anomalies and indices of a batch of cycles
 
-    if pattern:
-        print(f' - Reading {pattern} files')
-    else:
-        print(f' - Reading {type} files')
+    Params:
+        cycle_dss (List[Dataset]): the gridded cycles
+        grids (Dict): see load_global_grids
+        pattern_contexts (Dict): pattern -> context, see load_pattern_context
+        pattern_fields (Dict): pattern -> flattened pattern values
+        projectors (Dict): pattern -> projector cache, see index_projection
+    Returns:
+        global_dsms (Dataset): see calc_global_fields
+        spatial_means (ndarray): see calc_global_fields
+        agg_das (Dict): pattern -> detrended SSHA in the pattern's region
+        anoms (Dict): pattern -> anomalies, see calc_pattern_anoms
+        indices (Dict): pattern -> index of every cycle
+    """
+    global_dsms, spatial_means = calc_global_fields(cycle_dss, grids)
 
-    all_ds = []
-    for c in files:
-        all_ds.append(xr.open_dataset(c))
+    # Remove the seasonal cycle per pattern
+    agg_das = {}
+    anoms = {}
+    for pattern, context in pattern_contexts.items():
+        agg_da = global_dsms['SSHA_GLOBAL_removed_linear_trend'].isel(longitude=context['lon_idx'],
+                                                                      latitude=context['lat_idx'])
+        agg_da.name = f'SSHA_{pattern}_removed_global_linear_trend'
+        agg_das[pattern] = agg_da
+        anoms[pattern] = calc_pattern_anoms(agg_da, context)
 
-    print(f' - Concatenating {type} files')
-    concat_ds = xr.concat(all_ds, dim='time')
-    all_ds = []
+    # Do the actual index calculation per pattern
+    indices = {pattern: project_indices(pattern_fields[pattern], anoms[pattern].reshape(len(cycle_dss), -1),
+                                        projectors[pattern])
+               for pattern in pattern_contexts}
 
-    return concat_ds
+    return global_dsms, spatial_means, agg_das, anoms, indices
 
 
-def indicators():
+def indicators(full_rebuild=INDICATORS_FULL_REBUILD):
     """
     This function calculates indicator values for each regridded cycle. Those are
-    saved locally to avoid overloading memory. All locally saved indicator files 
-    are combined into a single netcdf spanning the entire 1992 - NOW time period.
+    saved to per product time series stores (see indicator_store), which are
+    exported to netcdfs spanning the entire 1992 - NOW time period.
+
+    Only cycles whose gridded file's content changed since their indicators were
+    calculated are recalculated, overwriting their slot in the stores. full_rebuild recreates
+    the stores and recalculates every cycle. Cycles that fail keep their previous
+    values and are recalculated on the next run.
     """
     # Get all gridded cycles
     grids = glob(f'{OUTPUT_DIR}/gridded_cycles/*.nc')
     grids.sort()
 
-    update = False
-
     os.makedirs(f'{OUTPUT_DIR}/indicator/', exist_ok=True)
     os.chmod(f'{OUTPUT_DIR}/indicator/', 0o777)
 
     # Check if we need to recalculate indicators
     data_path = f'{OUTPUT_DIR}/indicator/indicators.nc'
-    if os.path.exists(data_path):
-        ind_mod_time = datetime.fromtimestamp(os.path.getmtime(data_path))
-        for grid in grids:
-            grid_mod_time = datetime.fromtimestamp(os.path.getmtime(grid))
+    grid_inputs = stat_inputs(grids, OUTPUT_DIR)
+    indicator_params = {'patterns': PATTERNS}
 
-            if grid_mod_time >= ind_mod_time:
-                update = True
+    def mtime_check():
+        ind_mod_time = os.path.getmtime(data_path)
+        return any(os.path.getmtime(grid) >= ind_mod_time for grid in grids)
 
-                backup_dir = f'{OUTPUT_DIR}/indicator/backups'
-                os.makedirs(backup_dir, exist_ok=True)
-                os.chmod(backup_dir, 0o777)
+    update = full_rebuild or is_stale(data_path, grid_inputs, indicator_params, legacy_check=mtime_check)
 
-                # Copy old indicator file as backup
-                try:
-                    print('Making backup of existing indicator file.\n')
-                    backup_path = f'{backup_dir}/indicator_{ind_mod_time}.nc'
-                    copyfile(data_path, backup_path)
-                except Exception as e:
-                    logging.exception(f'Error creating indicator backup: {e}')
-                break
-    else:
-        update = True
+    if update and os.path.exists(data_path):
+        ind_mod_time = datetime.fromtimestamp(os.path.getmtime(data_path))
+
+        backup_dir = f'{OUTPUT_DIR}/indicator/backups'
+        os.makedirs(backup_dir, exist_ok=True)
+        os.chmod(backup_dir, 0o777)
+
+        # Copy old indicator file as backup
+        try:
+            print('Making backup of existing indicator file.\n')
+            backup_path = f'{backup_dir}/indicator_{ind_mod_time}.nc'
+            copyfile(data_path, backup_path)
+        except Exception as e:
+            logging.exception(f'Error creating indicator backup: {e}')
     
     # ONLY PROCEED IF THERE ARE CYCLES NEEDING CALCULATING
     if not update:
         logging.info('No regridded cycles modified since last index calculation.')
         return True
 
-    logging.info('Calculating new index values for cycles.')
+    indicator_dir = f'{OUTPUT_DIR}/indicator'
+    products = product_names(PATTERNS)
+
+    os.makedirs(INDICATOR_STORE_DIR, exist_ok=True)
+    os.chmod(INDICATOR_STORE_DIR, 0o777)
+
+    # Stores calculated with other patterns can't be updated
+    manifest = load_manifest(data_path) or {}
+    if manifest.get('params') != indicator_params or not stores_exist(products):
+        full_rebuild = True
+
+    if full_rebuild:
+        for product in products:
+            if os.path.exists(store_path(product)):
+                os.remove(store_path(product))
+
+    # Checksums are reused from the manifest for grids whose size and mtime are unchanged
+    fingerprints = {key: fingerprint(path, size, mtime, manifest.get('inputs', {}).get(key))
+                    for key, (path, size, mtime) in grid_inputs.items()}
+
+    grid_dates = {grid: gridded_cycle_date(grid) for grid in grids}
+    grid_sources = {path: source_id(fingerprints[key]['checksum']) for key, (path, *_) in grid_inputs.items()}
+    calculated = calculated_cycles()
+
+    cycles = [grid for grid in grids if calculated.get(grid_dates[grid]) != grid_sources[grid]]
+
+    # Cycles whose gridded file is gone
+    for date in set(calculated) - set(grid_dates.values()):
+        clear_cycle(date, products)
+
+    logging.info(f'Calculating new index values for {len(cycles)} of {len(grids)} cycles.')
 
     # ==============================================
     # Pattern preparation
     # ==============================================
 
-    patterns = ['enso', 'pdo', 'iod']
-
-    pattern_ds = dict()
-    pattern_geo_bnds = dict()
-    ann_cyc_in_pattern = dict()
-    pattern_area_defs = dict()
+    patterns = PATTERNS
 
     # Global grid
     ecco_latlon_grid = xr.open_dataset('ref_files/GRID_GEOMETRY_ECCO_V4r4_latlon_0p50deg.nc')
 
     global_lon = ecco_latlon_grid.longitude.values
     global_lat = ecco_latlon_grid.latitude.values
-    global_lon_m, global_lat_m = np.meshgrid(global_lon, global_lat)
-
-    pattern_area_defs['global'] = pr.geometry.SwathDefinition(lons=global_lon_m,
-                                                              lats=global_lat_m)
 
     # load the monthly global sla climatology
     ann_ds = xr.open_dataset('ref_files/ann_pattern.nc')
 
-    # load patterns and select out the monthly climatology of sla variation
-    # in each pattern
-    for pattern in patterns:
-        # load each pattern
-        pattern_fname = f'{pattern}_pattern_and_index.nc'
-        pattern_ds[pattern] = xr.open_dataset(f'ref_files/{pattern_fname}')
-
-        # get the geographic bounds of each sla pattern
-        pattern_geo_bnds[pattern] = [float(pattern_ds[pattern].Latitude[0].values),
-                                     float(pattern_ds[pattern].Latitude[-1].values),
-                                     float(pattern_ds[pattern].Longitude[0].values),
-                                     float(pattern_ds[pattern].Longitude[-1].values)]
-
-        # extract the sla annual cycle in the region of each pattern
-        ann_cyc_in_pattern[pattern] = ann_ds.sel(Latitude=slice(pattern_geo_bnds[pattern][0],
-                                                                pattern_geo_bnds[pattern][1]),
-                                                 Longitude=slice(pattern_geo_bnds[pattern][2],
-                                                                 pattern_geo_bnds[pattern][3]))
-
-        # Individual Patterns
-        lon_m, lat_m = np.meshgrid(pattern_ds[pattern].Longitude.values,
-                                   pattern_ds[pattern].Latitude.values)
-        tmp_lon, tmp_lat = check_and_wrap(lon_m, lat_m)
-        pattern_area_defs[pattern] = pr.geometry.SwathDefinition(lons=tmp_lon,
-                                                                 lats=tmp_lat)
+    # masks, area weights and trend rasters used on every cycle
+    global_grids = load_global_grids(ecco_latlon_grid)
+
+    # load each pattern and locate it on the global grid
+    pattern_contexts = {pattern: load_pattern_context(pattern, global_lon, global_lat, ann_ds)
+                        for pattern in patterns}
 
     # ==============================================
     # Calculate indicators for each updated (re)gridded cycle
     # ==============================================
 
-    os.makedirs(f'{OUTPUT_DIR}/indicator/daily', exist_ok=True)
-    os.chmod(f'{OUTPUT_DIR}/indicator/daily', 0o777)
+    # Cycles are saved to the stores in the background while the next cycle is calculated
+    writes = deque()
 
-    for cycle in grids:
+    # A cycle that fails to recalculate or save keeps its previous values, as
+    # the failure is more likely a transient read or write error than a bad
+    # grid. Its slot still records the old grid's checksum and its grid is
+    # left out of the manifest, so the next run retries it.
+    failed_dates = set()
 
-        try:
-            cycle_ds = xr.open_dataset(cycle)
-            cycle_ds.close()
+    def log_failed_writes(max_pending=0):
+        for date, e in finished_writes(writes, max_pending):
+            if e:
+                logging.error(f'Saving {date} cycle indicators failed: {e}')
+                failed_dates.add(date)
 
-            date = cycle.split('_')[-1][:8]
-            date = f'{date[:4]}-{date[4:6]}-{date[6:8]}'
+    # Index fits are solved for a batch of cycles at once, reusing each
+    # pattern's least squares projector while the fitted cells don't change
+    pattern_fields = {pattern: pattern_contexts[pattern]['field'].ravel() / 1e3
+                      for pattern in patterns}
+    projectors = {pattern: {} for pattern in patterns}
 
-            # Skip this grid if it's missing too much data
-            if not validate_counts(cycle_ds):
-                logging.exception(f'Too much data missing from {date} cycle. Skipping.')
-                continue
+    def calc_cycles(cycles_batch):
+        return calc_batch([cycle_ds for *_, cycle_ds in cycles_batch], global_grids, pattern_contexts,
+                          pattern_fields, projectors)
 
-            print(f' - Calculating index values for {date}')
+    for batch_start in range(0, len(cycles), INDICATOR_BATCH_SIZE):
+        batch = []
 
-            ct = np.datetime64(date)
+        for cycle in cycles[batch_start:batch_start + INDICATOR_BATCH_SIZE]:
 
-            # Area mask the cycle data
-            global_dam = cycle_ds.where(
-                ecco_latlon_grid.maskC.isel(Z=0) > 0)['SSHA']
-            global_dam = global_dam.where(global_dam)
+            try:
+                date = str(grid_dates[cycle])
 
-            global_dam.name = 'SSHA_GLOBAL'
-            global_dam.attrs['comment'] = 'Global SSHA land masked'
-            global_dsm = global_dam.to_dataset()
+                cycle_ds = load_gridded_cycle(cycle)
 
-            # Spatial Mean
-            mean_da = calc_spatial_mean(global_dam, ecco_latlon_grid, ct)
+                # Skip this grid if it's missing too much data
+                if not validate_counts(cycle_ds):
+                    logging.exception(f'Too much data missing from {date} cycle. Skipping.')
+                    clear_cycle(grid_dates[cycle], products)
+                    continue
 
-            global_dam_removed_mean = global_dam - mean_da.values
-            global_dam_removed_mean.attrs['comment'] = 'Global SSHA with global spatial mean removed'
-            global_dsm['SSHA_GLOBAL_removed_global_spatial_mean'] = global_dam_removed_mean
+                if not (np.array_equal(cycle_ds.longitude.values, global_lon) and
+                        np.array_equal(cycle_ds.latitude.values, global_lat)):
+                    raise ValueError(f'{date} cycle is not on the global grid')
 
-            # Linear Trend
-            trend = calc_linear_trend(cycle_ds)
-            global_dsm['SSHA_GLOBAL_linear_trend'] = trend
+                print(f' - Calculating index values for {date}')
+                batch.append((cycle, date, cycle_ds))
 
-            global_dam_detrended = global_dam - trend
-            global_dam_detrended.attrs['comment'] = 'Global SSHA with linear trend removed'
-            global_dsm['SSHA_GLOBAL_removed_linear_trend'] = global_dam_detrended
+            except Exception as e:
+                logging.exception(e)
+                failed_dates.add(date)
 
-            if 'Z' in global_dsm.data_vars:
-                global_dsm = global_dsm.drop_vars('Z')
+        if not batch:
+            continue
 
-            pattern_and_anom_das = {}
+        # If the batch fails, its cycles are retried one at a time so that
+        # one bad cycle doesn't fail the others
+        try:
+            calculations = [(batch, calc_cycles(batch))]
+        except Exception as e:
+            logging.exception(e)
+            calculations = []
+            failed = batch
+            if len(batch) > 1:
+                logging.warning(f'Retrying the {len(batch)} cycles of the failed batch one at a time.')
+                failed = []
+                for item in batch:
+                    try:
+                        calculations.append(([item], calc_cycles([item])))
+                    except Exception as e:
+                        logging.exception(e)
+                        failed.append(item)
+
+            for cycle, date, _ in failed:
+                logging.error(f'Index calculation for {date} cycle failed.')
+                failed_dates.add(date)
+
+        for sub_batch, (global_dsms, spatial_means, agg_das, anoms, indices) in calculations:
+            for i, (cycle, date, cycle_ds) in enumerate(sub_batch):
 
-            all_indicators = []
+                try:
+                    global_dsm = global_dsms.isel(time=i)
 
-            # Do the actual index calculation per pattern
-            for pattern in patterns:
-                pattern_lats = pattern_ds[pattern]['Latitude']
-                pattern_lats = pattern_lats.rename({'Latitude': 'latitude'})
-                pattern_lons = pattern_ds[pattern]['Longitude']
-                pattern_lons = pattern_lons.rename({'Longitude': 'longitude'})
-                pattern_lons, pattern_lats = check_and_wrap(pattern_lons, pattern_lats)
+                    mean_da = xr.DataArray(spatial_means[i], coords={'time': np.datetime64(date)},
+                                           attrs=global_dsm['SSHA_GLOBAL'].attrs)
+                    mean_da.name = 'spatial_mean'
+                    mean_da.attrs['comment'] = 'Global SSHA spatial mean'
 
-                agg_da = global_dsm['SSHA_GLOBAL_removed_linear_trend'].sel(longitude=pattern_lons, 
-                                                                            latitude=pattern_lats)
-                agg_da.name = f'SSHA_{pattern}_removed_global_linear_trend'
+                    pattern_and_anom_das = {}
+                    all_indicators = []
 
-                agg_ds = agg_da.to_dataset()
-                agg_ds.attrs = cycle_ds.attrs
+                    for pattern in patterns:
+                        agg_ds = agg_das[pattern].isel(time=i).to_dataset()
+                        agg_ds.attrs = cycle_ds.attrs
+                        ct = agg_ds.time.values
 
-                index_calc, ct, ssha_anom = calc_climate_index(agg_ds, pattern,
-                                                            pattern_ds, ann_cyc_in_pattern)
+                        anom_name = f'SSHA_{pattern}_removed_global_linear_trend_and_seasonal_cycle'
+                        agg_ds[anom_name] = xr.DataArray(anoms[pattern][i], dims=['latitude', 'longitude'],
+                                                         coords={'longitude': agg_ds.longitude.values,
+                                                                 'latitude': agg_ds.latitude.values})
 
-                anom_name = f'SSHA_{pattern}_removed_global_linear_trend_and_seasonal_cycle'
-                ssha_anom.name = anom_name
+                        # Handle patterns and anoms
+                        pattern_and_anom_das[pattern] = agg_ds
 
-                agg_ds[anom_name] = ssha_anom
+                        # Handle indicators and offsets
+                        indicator_da = xr.DataArray(indices[pattern][i], coords={'time': ct})
+                        indicator_da.name = f'{pattern}_index'
+                        all_indicators.append(indicator_da)
 
-                # Handle patterns and anoms
-                pattern_and_anom_das[pattern] = agg_ds
+                        offsets_da = xr.DataArray(0, coords={'time': ct})
+                        offsets_da.name = f'{pattern}_offset'
+                        all_indicators.append(offsets_da)
 
-                # Handle indicators and offsets
-                indicator_da = xr.DataArray(index_calc[1], coords={'time': ct})
-                indicator_da.name = f'{pattern}_index'
-                all_indicators.append(indicator_da)
+                    # Merge pattern indicators, offsets, and global spatial mean
+                    all_indicators.append(mean_da)
+                    indicator_ds = xr.merge(all_indicators)
+                    indicator_ds = indicator_ds.expand_dims(time=[indicator_ds.time.values])
 
-                offsets_da = xr.DataArray(index_calc[0], coords={'time': ct})
-                offsets_da.name = f'{pattern}_offset'
-                all_indicators.append(offsets_da)
+                    globals_ds = global_dsm
+                    globals_ds = globals_ds.expand_dims(time=[globals_ds.time.values])
 
-            # Merge pattern indicators, offsets, and global spatial mean
-            all_indicators.append(mean_da)
-            indicator_ds = xr.merge(all_indicators)
-            indicator_ds = indicator_ds.expand_dims(time=[indicator_ds.time.values])
+                    cycle_products = {'indicators': indicator_ds, 'globals': globals_ds}
+                    for pattern, pattern_anom_ds in pattern_and_anom_das.items():
+                        cycle_products[f'{pattern}_anoms'] = pattern_anom_ds.expand_dims(time=[pattern_anom_ds.time.values])
 
-            globals_ds = global_dsm
-            globals_ds = globals_ds.expand_dims(time=[globals_ds.time.values])
+                    for product, product_ds in cycle_products.items():
+                        if not os.path.exists(store_path(product)):
+                            create_product_store(product, product_ds)
 
-            # Save indicators ds, global ds, and individual pattern ds for this one cycle
-            save_files(date, indicator_ds, globals_ds, pattern_and_anom_das)
+                    # Save indicators ds, global ds, and individual pattern ds for this one cycle
+                    writes.append((date, writer_pool().submit(write_cycle, grid_dates[cycle], cycle_products,
+                                                              grid_sources[cycle])))
 
-        except Exception as e:
-            logging.exception(e)
+                except Exception as e:
+                    logging.exception(e)
+                    failed_dates.add(date)
+
+                log_failed_writes(OUTPUT_PENDING_WRITES)
+
+    # Every cycle must be in the stores before they're exported
+    log_failed_writes()
 
     print('\nCycle index calculation complete. ')
     print('Merging and saving final indicator products.\n')
 
     # ==============================================
-    # Combine daily indicator files
+    # Export the stores
     # ==============================================
 
     try:
-        indicator_dir = f'{OUTPUT_DIR}/indicator'
-
-        # open_mfdataset is too slow so we glob instead
-        indicators = concat_files(indicator_dir, 'indicator')
         print(' - Saving indicator file\n')
-        indicators.to_netcdf(f'{indicator_dir}/indicators.nc')
+        export_product('indicators', data_path)
 
         for pattern in patterns:
-            pattern_anoms = concat_files(
-                indicator_dir, 'pattern_anom', pattern)
             print(f' - Saving {pattern} anom file\n')
-            pattern_anoms.to_netcdf(f'{indicator_dir}/{pattern}_anoms.nc')
-            pattern_anoms = None
+            export_product(f'{pattern}_anoms', f'{indicator_dir}/{pattern}_anoms.nc')
 
-        globals_ds = concat_files(indicator_dir, 'global')
         print(' - Saving global file\n')
-        globals_ds.to_netcdf(f'{indicator_dir}/globals.nc')
-        globals_ds = None
+        export_product('globals', f'{indicator_dir}/globals.nc')
+
+        if failed_dates:
+            logging.error(f'Indicators for {len(failed_dates)} cycles failed and will be retried next run: '
+                          f'{sorted(failed_dates)}')
+        save_manifest(data_path, {key: fingerprints[key] for key, (path, *_) in grid_inputs.items()
+                                  if str(grid_dates[path]) not in failed_dates}, indicator_params)
 
     except Exception as e:
         logging.exception(e)
@@ -0,0 +1,136 @@
+'''
+Change detection manifests stored next to pipeline outputs.
+
+A manifest records a (size, mtime, checksum) fingerprint for every input used
+to build an output, along with the parameters used. An output is only stale
+when an input's content or the parameters change. Inputs whose size and mtime
+still match are trusted without rehashing; inputs with a new mtime are
+rehashed, so copies, rsyncs, touches and restored backups don't trigger a
+recompute.
+'''
+import hashlib
+import json
+import logging
+import os
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+def manifest_path(output_path):
+    return f'{output_path}{MANIFEST_SUFFIX}'
+
+
+def file_checksum(path, block_size=2**20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def stat_inputs(paths, root):
+    '''
+    Builds the inputs mapping for a list of files, keyed by path relative to
+    root so that manifests survive the archive being moved.
+
+    Returns:
+        inputs (dict): key -> (path, size, mtime)
+    '''
+    inputs = {}
+    for path in paths:
+        stat = os.stat(path)
+        inputs[os.path.relpath(path, root)] = (path, stat.st_size, stat.st_mtime)
+    return inputs
+
+
+def fingerprint(path, size, mtime, previous=None):
+    '''
+    Reuses the previous checksum when size and mtime are unchanged
+    '''
+    if previous and previous['size'] == size and previous['mtime'] == mtime:
+        checksum = previous['checksum']
+    else:
+        checksum = file_checksum(path)
+    return {'size': size, 'mtime': mtime, 'checksum': checksum}
+
+
+def load_manifest(output_path):
+    try:
+        with open(manifest_path(output_path), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_manifest(output_path, fingerprints, params):
+    path = manifest_path(output_path)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'params': params, 'inputs': fingerprints}, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def write_manifest(output_path, inputs, params):
+    '''
+    Records the inputs and parameters used to build output_path.
+
+    Params:
+        output_path (str): the product the manifest describes
+        inputs (dict): key -> (path, size, mtime), see stat_inputs
+        params (dict): JSON serializable parameters used to build the product
+    '''
+    previous = (load_manifest(output_path) or {}).get('inputs', {})
+    fingerprints = {key: fingerprint(path, size, mtime, previous.get(key))
+                    for key, (path, size, mtime) in inputs.items()}
+    save_manifest(output_path, fingerprints, params)
+
+
+def is_stale(output_path, inputs, params, legacy_check=None):
+    '''
+    Decides whether output_path needs to be rebuilt from inputs with params.
+
+    Outputs written before manifests existed have no manifest. They are judged
+    by legacy_check (stale if none is given) and adopted with a fresh manifest
+    when they are up to date.
+
+    Params:
+        output_path (str): the product to check
+        inputs (dict): key -> (path, size, mtime), see stat_inputs
+        params (dict): JSON serializable parameters the product should be built with
+        legacy_check (callable): fallback staleness check for outputs without a manifest
+
+    Returns:
+        stale (bool)
+    '''
+    if not os.path.exists(output_path):
+        return True
+
+    manifest = load_manifest(output_path)
+    if manifest is None:
+        stale = legacy_check() if legacy_check else True
+        if not stale:
+            write_manifest(output_path, inputs, params)
+        return stale
+
+    if manifest['params'] != params or set(manifest['inputs']) != set(inputs):
+        return True
+
+    fingerprints = {}
+    refreshed = False
+    for key, (path, size, mtime) in inputs.items():
+        previous = manifest['inputs'][key]
+        if previous['size'] != size:
+            return True
+
+        current = fingerprint(path, size, mtime, previous)
+        if current['checksum'] != previous['checksum']:
+            return True
+
+        refreshed = refreshed or current['mtime'] != previous['mtime']
+        fingerprints[key] = current
+
+    # Content is unchanged, remember the new mtimes to avoid rehashing next time
+    if refreshed:
+        logging.debug(f'Inputs of {output_path} touched but unchanged. Updating manifest.')
+        save_manifest(output_path, fingerprints, params)
+    return False
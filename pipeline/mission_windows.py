@@ -0,0 +1,86 @@
+'''
+Mission date windows from conf/datasets.yaml, compiled once into arrays so
+that granule dates can be filtered with vectorized comparisons.
+'''
+import logging
+from functools import lru_cache
+
+import numpy as np
+import yaml
+
+# Open ended windows ("now") never close
+OPEN_END = np.datetime64('9999-12-31', 'D')
+
+
+def parse_window_date(value, ds_name):
+    '''
+    Converts a YYYYMMDD config value to datetime64[D]. A single stray zero
+    after the year (ie: "201800712") is normalized with a warning, anything
+    else that isn't a valid date raises.
+    '''
+    value = str(value)
+    if value == 'now':
+        return OPEN_END
+
+    candidate = value
+    if len(value) == 9 and value[4] == '0':
+        candidate = value[:4] + value[5:]
+
+    if len(candidate) != 8 or not candidate.isdigit():
+        raise ValueError(f'Malformed date "{value}" for {ds_name} in datasets.yaml')
+
+    date = np.datetime64(f'{candidate[:4]}-{candidate[4:6]}-{candidate[6:]}', 'D')
+
+    if candidate != value:
+        logging.warning(f'Normalized malformed date "{value}" for {ds_name} to {date}')
+    return date
+
+
+@lru_cache()
+def load_mission_windows(config_path='conf/datasets.yaml'):
+    '''
+    Loads the dataset config once and compiles it into an interval table
+
+    Returns:
+        windows (dict): mission name -> index, plus parallel start and end arrays
+    '''
+    with open(config_path, "r") as stream:
+        config = yaml.load(stream, yaml.Loader)
+
+    names = [c['ds_name'] for c in config]
+    starts = np.array([parse_window_date(c['start'], c['ds_name']) for c in config])
+    ends = np.array([parse_window_date(c['end'], c['ds_name']) for c in config])
+
+    bad = starts > ends
+    if bad.any():
+        raise ValueError(f'Window start after end for {np.array(names)[bad].tolist()} in datasets.yaml')
+
+    return {
+        'index': {name: i for i, name in enumerate(names)},
+        'start': starts,
+        'end': ends
+    }
+
+
+def in_mission_window(missions, dates, windows=None):
+    '''
+    Checks each granule's date against its mission's window.
+
+    Params:
+        missions (list): mission name for each granule
+        dates (array-like): date for each granule, coercible to datetime64[D]
+        windows (dict): compiled windows, defaults to conf/datasets.yaml
+
+    Returns:
+        mask (ndarray): True where the granule's mission is configured and the
+                        date falls within its window
+    '''
+    if windows is None:
+        windows = load_mission_windows()
+
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    idx = np.array([windows['index'].get(m, -1) for m in missions], dtype=int)
+    known = idx >= 0
+    idx = np.where(known, idx, 0)
+
+    return known & (dates >= windows['start'][idx]) & (dates <= windows['end'][idx])
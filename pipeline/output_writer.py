@@ -0,0 +1,238 @@
+'''
+Shared netCDF writer for gridded cycles, ENSO grids and indicator files.
+
+Data variables are written as float32 with the codec, level and chunking set
+in conf/global_settings.py. Files are written to a temp file in the output
+directory and renamed into place, so readers never see a partial product.
+Every write logs its size and duration. Products spanning every cycle are
+written in time blocks by write_netcdf_blocks, bounding the memory they need.
+
+submit_write hands the write to a background writer thread so compression
+overlaps with computing the next product. The HDF5 library isn't thread
+safe, so writes share granule_cache's HDF5_LOCK with granule decoding and
+gridded cycle reads, and a single writer thread is used.
+'''
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import netCDF4
+import numpy as np
+import xarray as xr
+from netCDF4 import default_fillvals  # pylint: disable=no-name-in-module
+from xarray.conventions import encode_cf_variable
+
+from conf.global_settings import EXPORT_MAX_BYTES, OUTPUT_CHUNKS, OUTPUT_CODEC, OUTPUT_COMPLEVEL
+from granule_cache import HDF5_LOCK
+
+# Encoding for coordinates stored as float32 without fill values
+FLOAT32_COORDS = {'_FillValue': None, 'dtype': 'float32'}
+
+
+def compression_encoding(codec=OUTPUT_CODEC, complevel=OUTPUT_COMPLEVEL):
+    '''
+    netCDF4 compression settings for codec. zlib works with every version,
+    other codecs (ie: zstd, bzip2) need xarray >= 2022.09, netCDF4 >= 1.6 and
+    a netCDF-C library built with the codec's filter. See check_codec.
+    '''
+    if not codec:
+        return {}
+    if codec == 'zlib':
+        return {'zlib': True, 'complevel': complevel}
+    return {'compression': codec, 'complevel': complevel}
+
+
+def check_codec(codec=OUTPUT_CODEC, complevel=OUTPUT_COMPLEVEL):
+    '''
+    Saves a one value file with codec, so an unsupported OUTPUT_CODEC fails
+    before any stage runs rather than on every write
+    '''
+    if not codec or codec == 'zlib':
+        return
+
+    ds = xr.Dataset({'check': ('n', np.zeros(1, np.float32))})
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        try:
+            with HDF5_LOCK:
+                ds.to_netcdf(f'{tmp_dir}/check.nc', encoding={'check': compression_encoding(codec, complevel)})
+        except Exception as e:
+            raise ValueError(f'Output codec "{codec}" is not supported: {e}. Codecs other than zlib need '
+                             f'xarray >= 2022.09 (found {xr.__version__}) and netCDF4 >= 1.6 '
+                             f'(found {netCDF4.__version__}) built with the codec.') from e
+
+
+def netcdf_encoding(ds, coord_encoding=None, codec=OUTPUT_CODEC, complevel=OUTPUT_COMPLEVEL, chunks=OUTPUT_CHUNKS):
+    '''
+    Builds the encoding dictionary for saving ds.
+
+    Params:
+        ds (Dataset): the Dataset to save
+        coord_encoding (dict): encoding applied to every coordinate, xarray's defaults if None
+        codec (str): compression codec, None for uncompressed
+        complevel (int): compression level
+        chunks (dict): dimension -> chunk size, unlisted dimensions are not split
+
+    Returns:
+        encoding (dict): the encoding dictionary for ds
+    '''
+    var_encoding = {'dtype': 'float32',
+                    'shuffle': True,
+                    '_FillValue': default_fillvals['f8'],
+                    **compression_encoding(codec, complevel)}
+
+    encoding = {}
+    for var in ds.data_vars:
+        encoding[var] = dict(var_encoding)
+        if chunks and ds[var].dims:
+            encoding[var]['chunksizes'] = tuple(min(chunks.get(dim, size), size)
+                                                for dim, size in zip(ds[var].dims, ds[var].shape))
+
+    if coord_encoding is not None:
+        for coord in ds.coords:
+            encoding[coord] = dict(coord_encoding)
+
+    return encoding
+
+
+def write_atomically(path, write):
+    '''
+    Calls write with a temp path and renames the result to path.
+
+    Returns:
+        stats (dict): path, bytes written and seconds taken
+    '''
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+    start = time.perf_counter()
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    stats = {'path': path, 'bytes': os.path.getsize(path), 'seconds': time.perf_counter() - start}
+    logging.info(f'\tWrote {os.path.basename(path)}: {stats["bytes"] / 2**20:.1f} MB in {stats["seconds"]:.2f}s')
+    return stats
+
+
+def write_netcdf(ds, path, coord_encoding=None, codec=OUTPUT_CODEC, complevel=OUTPUT_COMPLEVEL, chunks=OUTPUT_CHUNKS):
+    '''
+    Saves ds to path atomically.
+
+    Returns:
+        stats (dict): path, bytes written and seconds taken
+    '''
+    encoding = netcdf_encoding(ds, coord_encoding, codec, complevel, chunks)
+
+    def write(tmp_path):
+        with HDF5_LOCK:
+            ds.to_netcdf(tmp_path, encoding=encoding)
+
+    return write_atomically(path, write)
+
+
+def block_size(ds, dim, max_bytes):
+    '''
+    Number of steps along dim that can be read, encoded and written within
+    max_bytes. Encoding copies a block, so each step is counted twice.
+    '''
+    step_bytes = sum(var.size // var.sizes[dim] * var.dtype.itemsize for var in ds.variables.values()
+                     if dim in var.dims and var.sizes[dim])
+    return max(1, max_bytes // max(1, 2 * step_bytes))
+
+
+def write_netcdf_blocks(ds, path, dim='time', max_bytes=EXPORT_MAX_BYTES, coord_encoding=None,
+                        codec=OUTPUT_CODEC, complevel=OUTPUT_COMPLEVEL, chunks=OUTPUT_CHUNKS):
+    '''
+    Saves a lazily opened ds to path atomically, reading and writing it in
+    blocks along dim so no more than about max_bytes are held at once. dim is
+    saved as an unlimited dimension.
+
+    The first block is written by xarray, which sets up the file and picks
+    the time units. Later blocks are CF encoded by xarray with the same
+    encoding and units, and appended with netCDF4, so the file matches one
+    written in a single pass.
+
+    Returns:
+        stats (dict): path, bytes written and seconds taken
+    '''
+    encoding = netcdf_encoding(ds, coord_encoding, codec, complevel, chunks)
+    step = block_size(ds, dim, max_bytes)
+    blocked = [name for name, var in ds.variables.items() if dim in var.dims]
+
+    def write(tmp_path):
+        with HDF5_LOCK:
+            ds.isel({dim: slice(0, step)}).load().to_netcdf(tmp_path, encoding=encoding, unlimited_dims=[dim])
+
+        for start in range(step, ds.sizes[dim], step):
+            block = ds[blocked].isel({dim: slice(start, start + step)}).load()
+
+            with HDF5_LOCK, netCDF4.Dataset(tmp_path, 'a') as nc:
+                nc.set_auto_maskandscale(False)
+                for name in blocked:
+                    var = block[name].variable.copy(deep=False)
+                    var.encoding = dict(encoding.get(name, {}))
+                    if np.issubdtype(var.dtype, np.datetime64):
+                        var.encoding.update({'units': nc[name].units, 'calendar': nc[name].calendar})
+                        var.encoding.setdefault('dtype', nc[name].dtype)
+
+                    region = tuple(slice(start, start + var.sizes[dim]) if d == dim else slice(None)
+                                   for d in var.dims)
+                    nc[name][region] = encode_cf_variable(var, name=name).values
+
+    return write_atomically(path, write)
+
+
+@lru_cache()
+def writer_pool():
+    '''
+    Background writer shared by every product in this process. Created on
+    first use, so pool workers forked beforehand each make their own.
+    '''
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix='output_writer')
+
+
+def submit_write(ds, path, after=None, **kwargs):
+    '''
+    Queues ds to be saved to path by the background writer. ds must not be
+    modified until the write completes.
+
+    Params:
+        ds (Dataset): the Dataset to save
+        path (str): output path
+        after (callable): run in the writer thread once the file is in place, ie: to record a manifest
+        kwargs: encoding options passed to write_netcdf
+
+    Returns:
+        future (Future): resolves to the write's stats
+    '''
+    def write():
+        stats = write_netcdf(ds, path, **kwargs)
+        if after:
+            after()
+        return stats
+
+    return writer_pool().submit(write)
+
+
+def finished_writes(pending, max_pending=0):
+    '''
+    Waits on the oldest writes until at most max_pending remain, also
+    collecting any later writes that are already done.
+
+    Params:
+        pending (deque): (key, future) pairs in submission order
+        max_pending (int): the number of writes allowed to remain pending
+
+    Yields:
+        (key, error): for every finished write. error is None on success.
+    '''
+    while pending and (pending[0][1].done() or len(pending) > max_pending):
+        key, future = pending.popleft()
+        yield key, future.exception()
@@ -1,6 +1,7 @@
 import os
 import warnings
 from datetime import datetime, date
+from functools import lru_cache
 from glob import glob
 
 import cartopy.crs as ccrs
@@ -16,9 +17,10 @@ from matplotlib import pyplot as plt
 warnings.filterwarnings('ignore')
 
 
-def make_akiko_cmap() -> colors.ListedColormap:
+@lru_cache()
+def akiko_cmap() -> colors.ListedColormap:
     '''
-    Converts colorscale txt file to mpl 
+    Converts colorscale txt file to mpl. Read on first use.
     '''
     values = []
     with open('ref_files/akiko_colorscale.txt', 'r') as f:
@@ -30,8 +32,6 @@ def make_akiko_cmap() -> colors.ListedColormap:
             values.append(row)
     return colors.ListedColormap(values, name='akiko_cmap')
 
-akiko_cmap = make_akiko_cmap()
-
 def date_sat_map(map_date: datetime.date) -> str:
     '''
     TOPEX/Poseidon -> Jason-1:  			14 May 2002
@@ -61,7 +61,7 @@ def plot_orth(enso_ds, date, satellite, vmin=-180, vmax=180):
     fig = plt.figure(figsize=(10,10))
     ax = fig.add_subplot(1, 1, 1, projection=ccrs.Orthographic(-150, 10))
     
-    ax.pcolormesh(enso_ds.longitude, enso_ds.latitude, enso_ds.SSHA, transform=ccrs.PlateCarree(), vmin=vmin, vmax=vmax, cmap=akiko_cmap, shading='nearest')
+    ax.pcolormesh(enso_ds.longitude, enso_ds.latitude, enso_ds.SSHA, transform=ccrs.PlateCarree(), vmin=vmin, vmax=vmax, cmap=akiko_cmap(), shading='nearest')
     ax.add_feature(cfeature.OCEAN, facecolor='lightgrey')
     ax.add_feature(cfeature.LAND, facecolor='dimgrey', zorder=10)
     ax.coastlines(zorder=11)
@@ -93,7 +93,7 @@ def plot_plate(enso_ds, date, satellite, vmin=-180, vmax=180):
     ax = fig.add_subplot(1, 1, 1, projection=ccrs.PlateCarree(-180))
     
     g = plt.pcolormesh(enso_ds.longitude, enso_ds.latitude, enso_ds.SSHA, transform=ccrs.PlateCarree(), 
-                       vmin=vmin, vmax=vmax, cmap=akiko_cmap)
+                       vmin=vmin, vmax=vmax, cmap=akiko_cmap())
     
     ax.add_feature(cfeature.OCEAN, facecolor='lightgrey')
     ax.add_feature(cfeature.LAND, facecolor='dimgrey', zorder=10)
@@ -121,7 +121,7 @@ def plot_orth_enso(enso_ds, date, vmin=-180, vmax=180):
     date_str = datetime.strftime(date, '%d %b %Y')
     fig = plt.figure(figsize=(14,10), dpi=70)
     ax = fig.add_subplot(1, 1, 1, projection=ccrs.Orthographic(-150, 10))
-    ax.pcolormesh(enso_ds.longitude, enso_ds.latitude, enso_ds.SSHA, transform=ccrs.PlateCarree(), vmin=vmin, vmax=vmax, cmap=akiko_cmap, shading='nearest')
+    ax.pcolormesh(enso_ds.longitude, enso_ds.latitude, enso_ds.SSHA, transform=ccrs.PlateCarree(), vmin=vmin, vmax=vmax, cmap=akiko_cmap(), shading='nearest')
     ax.add_feature(cfeature.OCEAN, facecolor='lightgrey')
     ax.add_feature(cfeature.LAND, facecolor='dimgrey', zorder=10)
     ax.coastlines(zorder=11)
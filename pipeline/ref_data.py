@@ -0,0 +1,60 @@
+'''
+Reference datasets read from ref_files, loaded on first use.
+
+Each loader reads its files the first time it is called and returns the same
+objects afterwards, so importing a module that uses them costs nothing and a
+run only pays for the reference data of the stages it runs. The returned
+datasets are shared, including with pool workers forked after they are
+loaded, so their arrays are made read-only.
+'''
+from functools import lru_cache
+
+import xarray as xr
+
+SEASONAL_CYCLE_PATH = 'ref_files/trnd_seas_simple_grid.nc'
+HR_MASK_PATH = 'ref_files/HR_GRID_MASK_latlon.nc'
+
+
+def wrap_longitude(ds, lon):
+    ds.coords[lon] = ds.coords[lon] % 360
+    return ds.sortby(ds[lon])
+
+
+def read_only(ds):
+    for var in ds.variables.values():
+        var.values.setflags(write=False)
+    return ds
+
+
+@lru_cache()
+def seasonal_cycle(path=SEASONAL_CYCLE_PATH):
+    '''
+    Reads the seasonal cycle and trend grid on 0-360 longitudes
+
+    Returns:
+        seas_ds (Dataset): monthly seasonal cycle with the SSH trend slope and offset
+        padded_seas_ds (Dataset): seas_ds with December before January and
+                                  January after December, so it can be
+                                  interpolated at any fraction of the year
+    '''
+    with xr.open_dataset(path) as ds:
+        seas_ds = wrap_longitude(ds.load(), 'Longitude')
+
+    front_seas_ds = seas_ds.isel(Month_grid=0)
+    back_seas_ds = seas_ds.isel(Month_grid=-1)
+    front_seas_ds = front_seas_ds.assign_coords({'Month_grid': front_seas_ds.Month_grid.values + (12/12)})
+    back_seas_ds = back_seas_ds.assign_coords({'Month_grid': back_seas_ds.Month_grid.values - (12/12)})
+    padded_seas_ds = xr.concat([back_seas_ds, seas_ds, front_seas_ds], dim='Month_grid')
+    return read_only(seas_ds), read_only(padded_seas_ds)
+
+
+@lru_cache()
+def hr_mask(path=HR_MASK_PATH):
+    '''
+    Reads the 0.25 degree wet/dry mask on 0-360 longitudes
+
+    Returns:
+        hr_mask_ds (Dataset): the mask
+    '''
+    with xr.open_dataset(path) as ds:
+        return read_only(wrap_longitude(ds.load(), 'longitude'))
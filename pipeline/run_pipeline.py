@@ -1,14 +1,17 @@
 import logging
+import sys
 from argparse import ArgumentParser
 
-import txt_engine
-import yaml
-from conf.global_settings import OUTPUT_DIR
-from cycle_gridding import cycle_gridding
-from indicators import indicators
+from conf.global_settings import (DEFAULT_GRIDDING_PROFILE, ENSO_WORKERS, GRIDDED_CYCLE_FORMAT, GRIDDING_PREFETCH,
+                                  GRIDDING_THREADS, GRIDDING_WORKERS, INDICATORS_FULL_REBUILD, OUTPUT_DIR)
+from gridded_cycles import GRIDDED_CYCLE_FORMATS
 from logs.logconfig import configure_logging
-import plotting
-import enso_grids
+from mission_windows import load_mission_windows
+from output_writer import check_codec
+
+# Each stage's modules (and their cartopy, matplotlib, pyresample and scipy
+# imports and reference data) are imported when the stage runs, so a run
+# only pays for the stages chosen.
 
 
 configure_logging(file_timestamp=False)
@@ -28,6 +31,33 @@ def create_parser():
     parser.add_argument('--options_menu', default=False, action='store_true',
                         help='Display option menu to select which steps in the pipeline to run.')
 
+    parser.add_argument('--full_scan', default=False, action='store_true',
+                        help='Check every cycle for updates instead of only those affected by new or modified granules.')
+
+    parser.add_argument('--workers', type=int, default=GRIDDING_WORKERS,
+                        help='Number of processes used to grid cycles in parallel.')
+
+    parser.add_argument('--threads', type=int, default=GRIDDING_THREADS,
+                        help='Number of threads each gridding process uses for resampling.')
+
+    parser.add_argument('--prefetch', type=int, default=GRIDDING_PREFETCH,
+                        help='Number of cycles merged ahead of the one being gridded when using a single worker. 0 disables streaming.')
+
+    parser.add_argument('--gridding_profile', type=str, default=DEFAULT_GRIDDING_PROFILE,
+                        help='Gridding profile from conf/gridding_profiles.yaml used for cycle gridding.')
+
+    parser.add_argument('--grid_format', type=str, default=GRIDDED_CYCLE_FORMAT, choices=GRIDDED_CYCLE_FORMATS,
+                        help='Save gridded cycles as full planes or compact wet cell vectors.')
+
+    parser.add_argument('--rebuild_indicators', default=INDICATORS_FULL_REBUILD, action='store_true',
+                        help='Recalculate indicators for every cycle instead of only new or regridded cycles.')
+
+    parser.add_argument('--enso_workers', type=int, default=ENSO_WORKERS,
+                        help='Number of processes used to make ENSO grids in parallel.')
+
+    parser.add_argument('--benchmark_gridding', type=int, default=0, metavar='N_CYCLES',
+                        help='Benchmark every gridding profile against production on a sample of cycles and exit.')
+
     # parser.add_argument('-gc', '--grid_cycles', type=str, default='', dest='grid_cycles',
     #                 help='Dataset to harvest')
 
@@ -47,25 +77,30 @@ def show_menu():
         print('2) Perform gridding')
         print('3) Calculate index values and generate txt output and plots')
         print('4) Generate ENSO grids and maps')
+        print('5) Regenerate index txt output')
         selection = input('Enter option number: ')
 
-        if selection in ['1', '2', '3', '4']:
+        if selection in ['1', '2', '3', '4', '5']:
             return selection
         print(f'Unknown option entered, "{selection}", please enter a valid option\n')
 
 
-def run_cycle_gridding():
+def run_cycle_gridding(full_scan=False, workers=GRIDDING_WORKERS, threads=GRIDDING_THREADS,
+                       profile=DEFAULT_GRIDDING_PROFILE, prefetch=GRIDDING_PREFETCH,
+                       grid_format=GRIDDED_CYCLE_FORMAT):
     try:
-        cycle_gridding()
+        from cycle_gridding import cycle_gridding
+        cycle_gridding(full_scan, workers, threads, profile, prefetch, grid_format)
         logging.info('Cycle gridding complete.')
     except Exception as e:
         logging.exception(f'Cycle gridding failed. {e}')
 
 
-def run_indexing() -> bool:
+def run_indexing(full_rebuild=INDICATORS_FULL_REBUILD) -> bool:
     success = False
     try:
-        success = indicators()
+        from indicators import indicators
+        success = indicators(full_rebuild)
         logging.info('Index calculation complete.')
     except Exception as e:
         logging.error(f'Index calculation failed: {e}')
@@ -74,25 +109,33 @@ def run_indexing() -> bool:
         return success
     
     try:
+        import plotting
         plotting.indicator_plots()
     except Exception as e:
         logging.error(f'Plot generation failed: {e}')
 
+    run_txt()
+
+    return success
+
+
+def run_txt():
     try:
+        import txt_engine
         txt_engine.generate_txt()
         logging.info('Index txt file creation complete.')
     except Exception as e:
         logging.error(f'Index txt file creation failed: {e}')
 
-    return success
-
-def run_enso():
+def run_enso(workers=ENSO_WORKERS):
     try: 
-        enso_grids.enso_gridding()
+        import enso_grids
+        enso_grids.enso_gridding(workers)
         logging.info('ENSO gridding complete.')
     except Exception as e:
         logging.error(f'ENSO gridding failed: {e}')
     try: 
+        import plotting
         plotting.enso_maps()
         logging.info('ENSO mapping complete.')
     except Exception as e:
@@ -106,28 +149,42 @@ if __name__ == '__main__':
 
     # --------------------- Run pipeline ---------------------
 
-    with open(f'conf/datasets.yaml', "r") as stream:
-        config = yaml.load(stream, yaml.Loader)
-    configs = {c['ds_name']: c for c in config}    
+    # Validates the mission windows and output codec up front
+    DATASET_NAMES = list(load_mission_windows()['index'].keys())
+    check_codec()
 
-    DATASET_NAMES = list(configs.keys())
+    if args.benchmark_gridding:
+        from gridding_benchmark import benchmark_profiles
+        benchmark_profiles(args.benchmark_gridding, args.threads)
+        sys.exit()
 
     CHOSEN_OPTION = show_menu() if args.options_menu else '1'
 
+    # Validates the gridding profile before any stage runs
+    if CHOSEN_OPTION in ['1', '2']:
+        from gridding_engines import get_gridding_profile
+        get_gridding_profile(args.gridding_profile)
+
     # Run harvesting, gridding, indexing, post processing
     if CHOSEN_OPTION == '1':
-        run_cycle_gridding()
-        run_indexing()
-        run_enso()
+        run_cycle_gridding(args.full_scan, args.workers, args.threads, args.gridding_profile, args.prefetch,
+                           args.grid_format)
+        run_indexing(args.rebuild_indicators)
+        run_enso(args.enso_workers)
 
     # Run gridding
     elif CHOSEN_OPTION == '2':
-        run_cycle_gridding()
+        run_cycle_gridding(args.full_scan, args.workers, args.threads, args.gridding_profile, args.prefetch,
+                           args.grid_format)
 
     # Run indexing (and post processing)
     elif CHOSEN_OPTION == '3':
-        run_indexing()
+        run_indexing(args.rebuild_indicators)
         
     # Run ENSO
     elif CHOSEN_OPTION == '4':
-        run_enso()
+        run_enso(args.enso_workers)
+
+    # Regenerate the txt file from the existing indicators
+    elif CHOSEN_OPTION == '5':
+        run_txt()